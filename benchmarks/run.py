@@ -0,0 +1,228 @@
+# benchmarks/run.py
+# Timing suite for the pipeline stages behind the README's "under 10 seconds" claim.
+#
+#   python -m benchmarks.run                  # compare against benchmarks/baseline.json
+#   python -m benchmarks.run --update         # record a new baseline on this machine
+#   python -m benchmarks.run --only synth161  # run the matching benchmarks only
+#
+# Cases: the bundled images/oct_segmentation1..3 plus synthetic 81- and 161-slice
+# stacks (generated once into a temp dir, same size as the bundled B-scans).
+# Each benchmark is repeated and its median kept. A benchmark regresses when it
+# is slower than its baseline by more than --tolerance (relative) and MIN_DELTA_S
+# (absolute, so sub-millisecond jitter never fails a run); end-to-end volume
+# must also stay under BUDGET_S. Any regression makes the run exit with 1.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from oct_pipeline.cli import uniform_slices
+from oct_pipeline.previews import build_previews, list_source_slices
+from oct_pipeline.registry import heatmap_stem, load_figure
+from oct_pipeline.segmentation import read_stack, segment_stack
+from oct_pipeline.volume import case_volume
+
+ROOT = Path(__file__).resolve().parent.parent
+IMG_DIR = ROOT / "images"
+BASELINE_PATH = Path(__file__).resolve().parent / "baseline.json"
+BASELINE_VERSION = 1
+
+BUDGET_S = 10.0          # README: contours + volume in under 10 seconds
+MIN_DELTA_S = 0.005
+SYNTH_SLICES = (81, 161)
+SYNTH_SIZE = (707, 384)  # (W, H) of the bundled B-scans
+
+# Acquisition geometry used for the volume benchmarks (as in the README example)
+SCAN_LENGTH_UM = 4820.0
+PIXEL_WIDTH_UM = 9.4
+PIXEL_DEPTH_UM = 3.5
+
+
+# ===== CASES =====
+def write_synthetic_case(out_dir: Path, n_slices: int, size: Tuple[int, int] = SYNTH_SIZE,
+                         seed: int = 0) -> Path:
+    """
+    RGB TIFF B-scans of a curved corneal band with an ulcer crater that deepens
+    towards the middle slice, plus speckle noise. Deterministic for a given seed.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    w, h = size
+    cols = np.arange(w, dtype=np.float32)
+    rows = np.arange(h, dtype=np.float32)[:, None]
+    surface = 0.15 * h + 0.25 * h * ((cols - w / 2) / (w / 2)) ** 2
+    for i in range(n_slices):
+        crater = 0.08 * h * np.exp(-((i - n_slices / 2) / (n_slices / 5)) ** 2)
+        anterior = surface + crater * np.exp(-((cols - w / 2) / (w / 10)) ** 2)
+        band = (rows >= anterior) & (rows < surface + 0.2 * h)
+        img = np.where(band, 170.0, 20.0) + rng.normal(0.0, 12.0, (h, w))
+        gray = np.clip(img, 0, 255).astype(np.uint8)
+        Image.fromarray(gray).convert("RGB").save(out_dir / f"synth_{n_slices}_{i:03d}.tif")
+    return out_dir
+
+
+def collect_cases(work_dir: Path) -> Dict[str, Path]:
+    cases = {}
+    for case_id in (1, 2, 3):
+        seg_dir = IMG_DIR / f"oct_segmentation{case_id}"
+        if list_source_slices(seg_dir):
+            cases[f"case{case_id}"] = seg_dir
+    for n in SYNTH_SLICES:
+        cases[f"synth{n}"] = write_synthetic_case(work_dir / f"synth{n}", n)
+    return cases
+
+
+# ===== TIMING =====
+def median_time(fn: Callable[[], object], repeat: int, setup: Optional[Callable[[], None]] = None) -> float:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return statistics.median(times)
+
+
+def _chart_spec(fig) -> str:
+    """What st.plotly_chart still does with a cached Figure on every rerun: copy, then serialize."""
+    import plotly.io as pio
+    import plotly.tools
+
+    return pio.to_json(plotly.tools.return_figure_from_figure_or_data(fig, validate_figure=True), validate=False)
+
+
+def run_benchmarks(cases: Dict[str, Path], work_dir: Path, repeat: int,
+                   only: Optional[str] = None) -> Dict[str, float]:
+    results: Dict[str, float] = {}
+    # Figures import plotly.graph_objects lazily; warm it so the first repeat
+    # of the first plotly_fig benchmark does not time the import
+    import plotly.graph_objects  # noqa: F401
+
+    def wanted(name: str) -> bool:
+        return not only or only in name
+
+    def bench(name: str, fn: Callable[[], object], setup: Optional[Callable[[], None]] = None,
+              per: int = 1) -> None:
+        if not wanted(name):
+            return
+        results[name] = median_time(fn, repeat, setup) / per
+        print(f"{name:<36} {results[name] * 1000:10.2f} ms", flush=True)
+
+    for name, seg_dir in cases.items():
+        prev_dir = work_dir / "previews" / name
+        paths, _ = uniform_slices(list_source_slices(seg_dir))
+
+        def wipe(prev_dir=prev_dir):
+            if prev_dir.exists():
+                for entry in os.scandir(prev_dir):
+                    if entry.is_file():
+                        os.remove(entry.path)
+
+        bench(f"previews_cold/{name}", lambda: build_previews(seg_dir, prev_dir), setup=wipe)
+        build_previews(seg_dir, prev_dir)
+        bench(f"previews_warm/{name}", lambda: build_previews(seg_dir, prev_dir))
+
+        if wanted(f"segment_per_slice/{name}"):
+            stack = read_stack(paths)   # decode outside the timed region
+            bench(f"segment_per_slice/{name}", lambda: segment_stack(stack), per=len(paths))
+        bench(f"volume_end_to_end/{name}",
+              lambda: case_volume(paths, SCAN_LENGTH_UM, PIXEL_WIDTH_UM, PIXEL_DEPTH_UM))
+
+        if name.startswith("case"):
+            stem = heatmap_stem(int(name[len("case"):]))
+            json_path = IMG_DIR / "heatmaps_json" / (stem + ".json")
+            npy_path = IMG_DIR / "heatmaps_npy" / (stem + ".npy")
+            if json_path.exists():
+                bench(f"plotly_fig_json/{name}", lambda: load_figure(json_path))
+            if npy_path.exists():
+                bench(f"plotly_fig_npy/{name}", lambda: load_figure(npy_path))
+            if npy_path.exists() and wanted(f"plotly_chart_spec/{name}"):
+                # Worst case the app caches: full resolution, interpolated between B-scans
+                fig = load_figure(npy_path, full_res=True, interp="linear")
+                bench(f"plotly_chart_spec/{name}", lambda: _chart_spec(fig))
+    return results
+
+
+# ===== BASELINE =====
+def machine_info() -> dict:
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(), "cpus": os.cpu_count()}
+
+
+def read_baseline(path: Path) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if data.get("version") == BASELINE_VERSION else None
+
+
+def write_baseline(path: Path, results: Dict[str, float], repeat: int) -> None:
+    old = read_baseline(path) or {}
+    merged = dict(old.get("results", {}), **results)   # --only updates a subset
+    data = {"version": BASELINE_VERSION, "machine": machine_info(), "repeat": repeat,
+            "results": dict(sorted(merged.items()))}
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def compare(results: Dict[str, float], baseline: Optional[dict], tolerance: float) -> List[str]:
+    """Human-readable failures: regressions against the baseline and blown time budgets."""
+    failures = []
+    base = (baseline or {}).get("results", {})
+    for name, t in sorted(results.items()):
+        if name.startswith("volume_end_to_end/") and t > BUDGET_S:
+            failures.append(f"{name}: {t:.2f} s exceeds the {BUDGET_S:.0f} s budget")
+        ref = base.get(name)
+        if ref is not None and t > ref * (1 + tolerance) and t - ref > MIN_DELTA_S:
+            failures.append(f"{name}: {t * 1000:.2f} ms vs baseline {ref * 1000:.2f} ms "
+                            f"(+{(t / ref - 1) * 100:.0f}%)")
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Time the pipeline stages and compare against a baseline.")
+    ap.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    ap.add_argument("--update", action="store_true", help="write the results as the new baseline")
+    ap.add_argument("--tolerance", type=float, default=0.5, help="allowed relative slowdown (0.5 = +50%%)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--only", default=None, help="run benchmarks whose name contains this string")
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="oct_bench_") as tmp:
+        work_dir = Path(tmp)
+        results = run_benchmarks(collect_cases(work_dir), work_dir, args.repeat, args.only)
+
+    if args.update:
+        write_baseline(args.baseline, results, args.repeat)
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    baseline = read_baseline(args.baseline)
+    if baseline is None:
+        print(f"no baseline at {args.baseline}; run with --update to record one", file=sys.stderr)
+    elif baseline.get("machine") != machine_info():
+        print("note: baseline was recorded on a different machine", file=sys.stderr)
+    failures = compare(results, baseline, args.tolerance)
+    for line in failures:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,7 @@
+"""
+Headless building blocks behind the Streamlit app: OCT B-scan segmentation,
+lesion measurements and the on-disk artefacts the page renders.
+
+Nothing in this package imports Streamlit, so it can be used from scripts,
+batch jobs and worker processes.
+"""
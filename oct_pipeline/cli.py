@@ -0,0 +1,190 @@
+# oct_pipeline/cli.py
+# Headless batch processing: previews, segmentation, volume and heatmap export
+# for every acquisition under a root folder, one case per worker process.
+#
+#   python -m oct_pipeline images/ --out-dir batch_output --workers 8 \
+#       --scan-length-um 6000 --pixel-width-um 9.4 --pixel-depth-um 3.5
+#
+# A case is any direct sub-folder of the root holding B-scans (.tif/.png/.jpg).
+# Results land in --out-dir:
+#   results.csv (or .parquet)   case, slices, volume, timings, error
+#   previews/<case>/            WebP previews, sprite sheet (+ tiles with --tile-size)
+#   volumes/<case>.npy          packed uint8 volume (volume_store)
+#   segmentation/<case>/        per-slice results + depth map, updated incrementally (slice_cache)
+#   heatmaps/<case>.npy         depth map (+ .meta.json), loadable by heatmaps.load_heatmap
+#   heatmaps/<case>_curvature.npy  anterior curvature map in 1/mm (curvature), same format
+
+import argparse
+import csv
+import os
+import sys
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from . import heatmaps
+from .curvature import curvature_heatmap, curvature_map, curvature_summary
+from .previews import build_previews, list_source_slices
+from .segmentation import SegmentationParams
+from .slice_cache import case_results, update_case
+from .volume_store import ensure_volume, open_volume
+
+RESULT_FIELDS = ["case", "slices", "frames", "skipped", "resegmented", "width", "height", "volume_ul", "max_depth_um",
+                 "radius_mm", "steep_radius_mm", "flat_radius_mm", "curvature_coverage",
+                 "t_previews_s", "t_pack_s", "t_segment_s", "t_heatmap_s", "t_curvature_s", "t_total_s", "error"]
+
+
+@dataclass
+class CaseJob:
+    name: str
+    seg_dir: Path
+    out_dir: Path
+    scan_length_um: float
+    pixel_width_um: float
+    pixel_depth_um: float
+    params: SegmentationParams
+    max_dim: int = 600
+    quality: int = 70
+    tile_size: Optional[int] = None
+
+
+def discover_cases(root: Path) -> Dict[str, Path]:
+    """{case name: folder} for every direct sub-folder of `root` that holds B-scans."""
+    cases = {}
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if entry.is_dir() and list_source_slices(Path(entry.path)):
+            cases[entry.name] = Path(entry.path)
+    return cases
+
+
+def uniform_slices(srcs: List[Path]) -> Tuple[List[Path], Tuple[int, int]]:
+    """
+    The slices sharing the most common size, and that (W, H) size (headers only).
+    Strays such as a raw export dropped next to the B-scans are left out.
+    """
+    sizes = {}
+    for p in srcs:
+        with Image.open(p) as img:
+            sizes[p] = img.size
+    size, _ = Counter(sizes.values()).most_common(1)[0]
+    return [p for p in srcs if sizes[p] == size], size
+
+
+def process_case(job: CaseJob) -> dict:
+    """Full pipeline for one case; never raises, failures are reported in the `error` column."""
+    row = {k: None for k in RESULT_FIELDS}
+    row["case"] = job.name
+    t0 = time.perf_counter()
+    try:
+        srcs = list_source_slices(job.seg_dir)
+        row["slices"] = len(srcs)
+
+        kept, (width, height) = uniform_slices(srcs)
+        row.update(skipped=len(srcs) - len(kept), width=width, height=height)
+
+        t = time.perf_counter()
+        volume = ensure_volume(kept, job.out_dir / "volumes" / f"{job.name}.npy")
+        row["frames"] = int(open_volume(volume).shape[0])
+        row["t_pack_s"] = time.perf_counter() - t
+
+        # Packed slices are rendered from the memmap; strays left out of the pack are decoded
+        t = time.perf_counter()
+        build_previews(job.seg_dir, job.out_dir / "previews" / job.name, max_dim=job.max_dim,
+                       quality=job.quality, workers=1, tile_size=job.tile_size, volume=volume)
+        row["t_previews_s"] = time.perf_counter() - t
+
+        # Only slices whose content changed since the last run are segmented again
+        t = time.perf_counter()
+        update = update_case(kept, job.out_dir / "segmentation" / job.name, job.scan_length_um,
+                             job.pixel_width_um, job.pixel_depth_um, job.params, volume=volume)
+        depth_um = np.asarray(update.depth) * job.pixel_depth_um
+        row["resegmented"] = len(update.resegmented)
+        row["volume_ul"] = update.volume.volume_ul
+        row["max_depth_um"] = float(depth_um.max())
+        row["t_segment_s"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        hm = heatmaps.heatmap_from_depth(depth_um, np.arange(width) * job.pixel_width_um,
+                                         np.arange(len(kept)) * update.volume.scan_spacing_um)
+        heatmaps.save_heatmap(hm, job.out_dir / "heatmaps" / job.name)
+        row["t_heatmap_s"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        smoothed = case_results(job.out_dir / "segmentation" / job.name, job.params).smoothed
+        k = curvature_map(smoothed, job.pixel_width_um, job.pixel_depth_um)
+        summary = curvature_summary(k)
+        row.update(radius_mm=summary.radius_mm, steep_radius_mm=summary.steep_radius_mm,
+                   flat_radius_mm=summary.flat_radius_mm, curvature_coverage=summary.coverage)
+        heatmaps.save_heatmap(curvature_heatmap(k, hm.x, hm.y), job.out_dir / "heatmaps" / f"{job.name}_curvature")
+        row["t_curvature_s"] = time.perf_counter() - t
+    except Exception:
+        row["error"] = traceback.format_exc(limit=3).strip().splitlines()[-1]
+    row["t_total_s"] = time.perf_counter() - t0
+    return row
+
+
+def write_results(rows: List[dict], path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == ".parquet":
+        import pandas as pd   # optional: only needed for Parquet output
+        pd.DataFrame(rows, columns=RESULT_FIELDS).to_parquet(path, index=False)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="python -m oct_pipeline",
+                                 description="Segment and map every OCT acquisition under a folder.")
+    ap.add_argument("root", type=Path, help="folder whose sub-folders are acquisitions")
+    ap.add_argument("--out-dir", type=Path, default=Path("batch_output"))
+    ap.add_argument("--results", default="results.csv", help="results table name (.csv or .parquet)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parallel cases")
+    ap.add_argument("--scan-length-um", type=float, required=True, help="raster length covered by the slices")
+    ap.add_argument("--pixel-width-um", type=float, required=True, help="lateral size of one A-scan column")
+    ap.add_argument("--pixel-depth-um", type=float, required=True, help="axial size of one pixel")
+    ap.add_argument("--tile-size", type=int, default=None, help="also build zoom tile pyramids")
+    ap.add_argument("--ksize", type=int, default=SegmentationParams.ksize)
+    ap.add_argument("--threshold", type=float, default=SegmentationParams.threshold)
+    ap.add_argument("--smooth-window", type=int, default=SegmentationParams.smooth_window)
+    return ap
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    cases = discover_cases(args.root)
+    if not cases:
+        print(f"no acquisitions found under {args.root}", file=sys.stderr)
+        return 1
+
+    params = SegmentationParams(ksize=args.ksize, threshold=args.threshold, smooth_window=args.smooth_window)
+    jobs = [CaseJob(name=name, seg_dir=seg_dir, out_dir=args.out_dir, scan_length_um=args.scan_length_um,
+                    pixel_width_um=args.pixel_width_um, pixel_depth_um=args.pixel_depth_um,
+                    params=params, tile_size=args.tile_size)
+            for name, seg_dir in cases.items()]
+
+    t0 = time.perf_counter()
+    rows = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(jobs)))) as pool:
+        futures = [pool.submit(process_case, job) for job in jobs]
+        for fut in as_completed(futures):
+            row = fut.result()
+            rows.append(row)
+            status = row["error"] or f"{row['volume_ul']:.3f} µL in {row['t_total_s']:.2f} s"
+            print(f"[{len(rows)}/{len(jobs)}] {row['case']}: {status}", flush=True)
+
+    rows.sort(key=lambda r: r["case"])
+    out = args.out_dir / args.results
+    write_results(rows, out)
+    n_failed = sum(1 for r in rows if r["error"])
+    print(f"{len(rows)} cases in {time.perf_counter() - t0:.1f} s, {n_failed} failed -> {out}")
+    return 1 if n_failed else 0
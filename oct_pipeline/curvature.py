@@ -0,0 +1,108 @@
+# oct_pipeline/curvature.py
+# Local curvature of the anterior corneal surface, for every column of every slice.
+#
+# Input is the smoothed anterior contour of a whole acquisition, an (n_slices, W)
+# array of image rows (SegmentationResult.smoothed). First and second
+# derivatives along the columns come from a local quadratic fit over `window`
+# columns (Savitzky-Golay): two correlations over the whole array, no per-slice
+# or per-column loop. With the pixel size, the curvature of the elevation
+# profile e(x) is
+#   k = -e'' / (1 + e'^2)^1.5        (1/mm, positive where the surface is convex)
+# and 1/k is the local radius. Columns whose fit window touches a missing
+# contour pick are NaN.
+
+import warnings
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+from scipy import ndimage
+from scipy.signal import savgol_filter
+
+from .heatmaps import Heatmap
+
+DEFAULT_WINDOW = 51      # columns per local fit (~0.5 mm at 9.4 µm per column)
+
+# Diverging: concave (blue) / flat (white) / convex (red)
+CURVATURE_COLORSCALE = [[0.0, "rgb(5,48,97)"], [0.25, "rgb(67,147,195)"], [0.5, "rgb(247,247,247)"],
+                        [0.75, "rgb(214,96,77)"], [1.0, "rgb(103,0,31)"]]
+
+
+@dataclass
+class CurvatureSummary:
+    radius_mm: float               # 1 / median curvature: overall radius of the anterior surface
+    steep_radius_mm: float         # 1 / 95th percentile curvature: steepest regions
+    flat_radius_mm: float          # 1 / 5th percentile curvature (inf when flat or concave)
+    slice_radius_mm: List[float]   # 1 / median curvature of each slice
+    coverage: float                # fraction of (slice, column) points with an estimate
+
+
+def curvature_map(contours: np.ndarray, pixel_width_um: float, pixel_depth_um: float,
+                  window: int = DEFAULT_WINDOW) -> np.ndarray:
+    """(n, W) float32 curvature in 1/mm of (n, W) contour rows (px, growing downwards)."""
+    contours = np.asarray(contours, dtype=np.float32)
+    if contours.ndim == 1:
+        contours = contours[None]
+    if window < 5 or window % 2 == 0:
+        raise ValueError(f"window must be an odd integer >= 5, got {window}")
+    if contours.shape[-1] < window:
+        return np.full(contours.shape, np.nan, dtype=np.float32)
+
+    valid = np.isfinite(contours)
+    rows = np.where(valid, contours, 0.0)
+    d1 = savgol_filter(rows, window, 2, deriv=1, axis=-1)
+    d2 = savgol_filter(rows, window, 2, deriv=2, axis=-1)
+    # Image rows grow downwards, so e = -row: the signs cancel in k = -e'' / (1 + e'^2)^1.5
+    slope = d1 * (pixel_depth_um / pixel_width_um)
+    k = d2 * (pixel_depth_um / pixel_width_um ** 2) / (1.0 + slope * slope) ** 1.5 * 1000.0
+    gaps = ndimage.maximum_filter1d((~valid).astype(np.uint8), window, axis=-1, mode="nearest") > 0
+    k[gaps] = np.nan
+    return k.astype(np.float32, copy=False)
+
+
+def _radius(k: float) -> float:
+    if not np.isfinite(k):
+        return float("nan")
+    return 1.0 / k if k > 0 else float("inf")
+
+
+def curvature_summary(k: np.ndarray) -> CurvatureSummary:
+    """Summary radii (mm) of a curvature map; medians and percentiles ignore NaNs."""
+    k = np.asarray(k, dtype=np.float64)
+    finite = np.isfinite(k)
+    if not finite.any():
+        nan = float("nan")
+        return CurvatureSummary(nan, nan, nan, [nan] * len(k), 0.0)
+    p5, p50, p95 = np.percentile(k[finite], [5, 50, 95])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # slices without any estimate
+        per_slice = np.nanmedian(k, axis=1)
+    return CurvatureSummary(radius_mm=_radius(p50), steep_radius_mm=_radius(p95), flat_radius_mm=_radius(p5),
+                            slice_radius_mm=[_radius(v) for v in per_slice], coverage=float(finite.mean()))
+
+
+def curvature_heatmap(k: np.ndarray, x_um: np.ndarray, y_um: np.ndarray) -> Heatmap:
+    """2D map of a curvature grid (x / y in µm, z in 1/mm), centred on flat."""
+    k = np.asarray(k, dtype=np.float32)
+    finite = k[np.isfinite(k)]
+    limit = float(np.percentile(np.abs(finite), 98)) if finite.size else 1.0
+    layout = {
+        "template": {},
+        "title": {"text": "Anterior curvature (1/mm)"},
+        "xaxis": {"title": {"text": "Length (µm)"}},
+        "yaxis": {"title": {"text": "Width (µm)"}},
+        "coloraxis": {"colorscale": CURVATURE_COLORSCALE, "cmin": -limit, "cmax": limit, "cmid": 0.0},
+    }
+    return Heatmap(z=k, x=np.asarray(x_um, dtype=np.float64), y=np.asarray(y_um, dtype=np.float64),
+                   colorscale=CURVATURE_COLORSCALE,
+                   hovertemplate="Curvature: %{z:.3f} /mm<extra></extra>",
+                   layout=layout, units_um={"x_unit_um": 1.0, "y_unit_um": 1.0})
+
+
+def curvature_figure(hm: Heatmap):
+    """Plotly 2D heatmap of a curvature map (NaN points left blank)."""
+    import plotly.graph_objects as go
+
+    trace = go.Heatmap(x=hm.x, y=hm.y, z=np.asarray(hm.z), coloraxis="coloraxis",
+                       hovertemplate=hm.hovertemplate)
+    return go.Figure(data=[trace], layout=hm.layout)
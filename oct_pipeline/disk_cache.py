@@ -0,0 +1,220 @@
+# oct_pipeline/disk_cache.py
+# Size-bounded, least-recently-used cache of byte blobs on local disk, shared
+# by every process pointing at the same directory (several app replicas, the
+# batch CLI, a restarted server...).
+#
+# Layout: <root>/<key[:2]>/<key>.bin, one file per entry. Writes go to a
+# temporary file and are renamed into place, so readers never see a partial
+# entry. A hit is an open + mmap of that file: the bytes are paged in on
+# demand, and arrays stored with put_arrays() come back as zero-copy views.
+# Recency is the file's mtime (refreshed on a hit at most every TOUCH_INTERVAL_S);
+# when the total goes over max_bytes, the oldest files are deleted. Every file
+# under the root counts, including ones written beside the blob API (the app's
+# per-slice segmentation results, see slice_cache). Each instance keeps a
+# running estimate of the total and only rescans the tree when its own writes
+# push the estimate over max_bytes or EVICT_INTERVAL_S has passed since the last
+# scan (other processes write too). Deleting a file another process still has
+# mapped is safe on POSIX.
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from .metrics import METRICS
+
+try:
+    import fcntl   # POSIX: serializes eviction between processes
+except ImportError:   # pragma: no cover - Windows
+    fcntl = None
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+TOUCH_INTERVAL_S = 60.0
+EVICT_INTERVAL_S = 60.0
+EVICT_TARGET = 0.9        # evictions free down to this fraction of max_bytes (no rescan on every put when full)
+LOCK_NAME = ".lock"
+
+# put_arrays() blob: 8-byte header length, JSON header, then 64-byte aligned raw arrays
+_HEADER = struct.Struct("<Q")
+_ALIGN = 64
+
+
+def cache_key(*parts) -> str:
+    """Stable key from any JSON-able parts (paths are stringified)."""
+    return hashlib.sha256(json.dumps(parts, default=str, sort_keys=True).encode()).hexdigest()
+
+
+def temp_path(dest: Path) -> Path:
+    """
+    Unique sibling of `dest` for a write-then-rename. Several writers (threads
+    or processes) may produce the same file at once; each renames its own copy.
+    """
+    dest = Path(dest)
+    return dest.with_name(f".{dest.name}.{uuid.uuid4().hex}.tmp")
+
+
+def _unlink(path) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class DiskCache:
+    def __init__(self, root: Path, max_bytes: int = DEFAULT_MAX_BYTES, name: str = "disk"):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self.name = name   # label of the hit / miss counters in METRICS
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._estimate = 0                   # bytes under root as of the last scan, plus our writes since
+        self._scanned_at = float("-inf")     # time.monotonic() of the last scan
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / (key + ".bin")
+
+    # ===== BYTES =====
+    def get(self, key: str) -> Optional[memoryview]:
+        """Read-only, memory-mapped view of the entry, or None on a miss."""
+        path = self.path(key)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            METRICS.inc("disk_cache_requests_total", cache=self.name, result="miss")
+            return None
+        try:
+            st = os.fstat(fd)
+            data = memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_READ)) if st.st_size else memoryview(b"")
+        finally:
+            os.close(fd)   # the mapping stays valid
+        if time.time() - st.st_mtime > TOUCH_INTERVAL_S:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        METRICS.inc("disk_cache_requests_total", cache=self.name, result="hit")
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # One temp file per writer: sessions are threads of one process and may put the same
+        # key at once; each rename is atomic, so readers see one complete copy or the other
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except FileNotFoundError:
+            # Lost a race with the cache folder being cleared: the entry is simply not cached
+            if tmp is not None:
+                _unlink(tmp)
+            return
+        except BaseException:
+            if tmp is not None:
+                _unlink(tmp)
+            raise
+        METRICS.inc("disk_cache_written_bytes_total", len(data), cache=self.name)
+        self.maybe_evict(len(data))
+
+    # ===== STRUCTURED VALUES =====
+    def get_json(self, key: str):
+        data = self.get(key)
+        return None if data is None else json.loads(bytes(data))
+
+    def put_json(self, key: str, value) -> None:
+        self.put(key, json.dumps(value, separators=(",", ":")).encode())
+
+    def get_arrays(self, key: str) -> Optional[Tuple[Dict[str, np.ndarray], dict]]:
+        """({name: read-only array view into the mapping}, meta), or None on a miss."""
+        data = self.get(key)
+        if data is None:
+            return None
+        (n,) = _HEADER.unpack_from(data, 0)
+        header = json.loads(bytes(data[_HEADER.size:_HEADER.size + n]))
+        arrays = {}
+        for name, spec in header["arrays"].items():
+            count = int(np.prod(spec["shape"], dtype=np.int64))
+            arrays[name] = np.frombuffer(data, dtype=spec["dtype"], count=count,
+                                         offset=spec["offset"]).reshape(spec["shape"])
+        return arrays, header["meta"]
+
+    def put_arrays(self, key: str, arrays: Dict[str, np.ndarray], meta: Optional[dict] = None) -> None:
+        arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+        specs = {name: {"dtype": a.dtype.str, "shape": list(a.shape), "offset": 0} for name, a in arrays.items()}
+        header = {"arrays": specs, "meta": meta or {}}
+        # Offsets depend on the header length, which depends on the offsets: reserve generously
+        head_len = len(json.dumps(header).encode()) + 32 * len(arrays) + 64
+        offset = -(-(_HEADER.size + head_len) // _ALIGN) * _ALIGN
+        for name, a in arrays.items():
+            specs[name]["offset"] = offset
+            offset = -(-(offset + a.nbytes) // _ALIGN) * _ALIGN
+        head = json.dumps(header).encode().ljust(head_len)
+        buf = bytearray(offset)
+        buf[:_HEADER.size] = _HEADER.pack(head_len)
+        buf[_HEADER.size:_HEADER.size + head_len] = head
+        for name, a in arrays.items():
+            start = specs[name]["offset"]
+            buf[start:start + a.nbytes] = a.tobytes()
+        self.put(key, bytes(buf))
+
+    # ===== EVICTION =====
+    def _entries(self):
+        """(path, size, mtime) of every file under root; locks and in-flight temp files are skipped."""
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.startswith(".") or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def maybe_evict(self, written: int = 0) -> int:
+        """
+        Add `written` bytes (stored by put(), or by another writer under root)
+        to the running estimate and evict if a scan is due; returns bytes freed.
+        """
+        self._estimate += written
+        if self._estimate > self.max_bytes or time.monotonic() - self._scanned_at > EVICT_INTERVAL_S:
+            return self.evict()
+        return 0
+
+    def total_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> int:
+        """
+        Delete least recently used entries once the cache is over max_bytes,
+        down to EVICT_TARGET of it; returns bytes freed.
+        """
+        with open(self.root / LOCK_NAME, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * EVICT_TARGET if total > self.max_bytes else total
+            freed = 0
+            for path, size, _ in entries:
+                if total - freed <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                freed += size
+        self._estimate = total - freed
+        self._scanned_at = time.monotonic()
+        if freed:
+            METRICS.inc("disk_cache_evicted_bytes_total", freed, cache=self.name)
+        return freed
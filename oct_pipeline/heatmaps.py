@@ -0,0 +1,227 @@
+# oct_pipeline/heatmaps.py
+# Compact binary storage for the 3D lesion topography (depth map) of each case.
+#
+# A depth map is stored as two files sharing a stem:
+#   <stem>.npy        float32 (n_slices, n_columns) depth grid, memory-mapped on load
+#   <stem>.meta.json  axis vectors, colorscale, hovertemplate and figure layout
+# The Plotly figure is rebuilt from those arrays, which is ~10x smaller on disk
+# and much faster to load than the pretty-printed Plotly JSON exports.
+#
+# One-shot conversion of the existing exports:
+#   python -m oct_pipeline.heatmaps images/heatmaps_json images/heatmaps_npy
+
+import json
+import os
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+META_SUFFIX = ".meta.json"
+FORMAT_VERSION = 1
+
+# The bundled heatmaps were exported with length (x) and depth (z) in 0.1 mm and
+# scan position (y) in µm; these convert each axis to µm (see volume.surface_volume).
+# Heatmaps that record their own `units_um` (e.g. from the batch CLI) use those instead.
+EXPORT_UNITS_UM = dict(x_unit_um=100.0, y_unit_um=1.0, z_unit_um=100.0)
+
+
+@dataclass
+class Heatmap:
+    z: np.ndarray                     # (n_slices, n_columns) depth grid, float32 (may be a memmap)
+    x: np.ndarray                     # (n_columns,) position along the B-scan
+    y: np.ndarray                     # (n_slices,) position of each B-scan
+    colorscale: Optional[list] = None
+    hovertemplate: Optional[str] = None
+    layout: dict = field(default_factory=dict)
+    units_um: Optional[dict] = None   # µm per unit of x / y / z, if known (see EXPORT_UNITS_UM)
+
+    @property
+    def n_slices(self) -> int:
+        return int(self.z.shape[0])
+
+    def axis_units_um(self) -> dict:
+        return self.units_um or EXPORT_UNITS_UM
+
+
+def heatmap_paths(stem_path: Path):
+    """(<stem>.npy, <stem>.meta.json) for a stem path (suffix ignored)."""
+    stem_path = Path(stem_path)
+    base = stem_path.with_name(stem_path.name.split(".")[0])
+    return base.with_suffix(".npy"), base.with_name(base.name + META_SUFFIX)
+
+
+# ===== SAVE / LOAD =====
+def save_heatmap(hm: Heatmap, stem_path: Path) -> Path:
+    """Write a heatmap as <stem>.npy + <stem>.meta.json; returns the .npy path."""
+    npy_path, meta_path = heatmap_paths(stem_path)
+    npy_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(npy_path, np.ascontiguousarray(hm.z, dtype=np.float32))
+    meta = {
+        "version": FORMAT_VERSION,
+        "shape": list(hm.z.shape),
+        "x": np.asarray(hm.x, dtype=np.float64).tolist(),
+        "y": np.asarray(hm.y, dtype=np.float64).tolist(),
+        "colorscale": hm.colorscale,
+        "hovertemplate": hm.hovertemplate,
+        "layout": hm.layout,
+    }
+    if hm.units_um:
+        meta["units_um"] = hm.units_um
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, separators=(",", ":"))
+    return npy_path
+
+
+def load_heatmap(stem_path: Path, mmap: bool = True) -> Heatmap:
+    """Load a binary heatmap; the depth grid is memory-mapped unless `mmap=False`."""
+    npy_path, meta_path = heatmap_paths(stem_path)
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    if meta.get("version") != FORMAT_VERSION:
+        raise ValueError(f"{meta_path.name}: unsupported heatmap format version {meta.get('version')}")
+    z = np.load(npy_path, mmap_mode="r" if mmap else None)
+    if list(z.shape) != meta["shape"]:
+        raise ValueError(f"{npy_path.name}: grid is {z.shape}, metadata says {tuple(meta['shape'])}")
+    return Heatmap(
+        z=z,
+        x=np.asarray(meta["x"], dtype=np.float64),
+        y=np.asarray(meta["y"], dtype=np.float64),
+        colorscale=meta.get("colorscale"),
+        hovertemplate=meta.get("hovertemplate"),
+        layout=meta.get("layout") or {},
+        units_um=meta.get("units_um"),
+    )
+
+
+def heatmap_exists(stem_path: Path) -> bool:
+    npy_path, meta_path = heatmap_paths(stem_path)
+    return npy_path.exists() and meta_path.exists()
+
+
+# ===== LEVEL OF DETAIL =====
+def decimate_columns(hm: Heatmap, factor: int) -> Heatmap:
+    """
+    Downsample along the A-scan (column) axis by averaging every `factor`
+    columns. Averaging preserves each slice's integrated area (hence the volume);
+    a trailing partial block is averaged over its own width.
+    """
+    if factor <= 1:
+        return hm
+    z = np.asarray(hm.z, dtype=np.float32)
+    starts = np.arange(0, z.shape[1], factor)
+    counts = np.diff(np.append(starts, z.shape[1])).astype(np.float32)
+    z_lod = np.add.reduceat(z, starts, axis=1) / counts
+    x_lod = np.add.reduceat(np.asarray(hm.x, dtype=np.float64), starts) / counts
+    return Heatmap(z=z_lod, x=x_lod, y=hm.y, colorscale=hm.colorscale,
+                   hovertemplate=hm.hovertemplate, layout=hm.layout, units_um=hm.units_um)
+
+
+def coarse_lod(hm: Heatmap, max_depth_error: Optional[float] = None, min_columns: int = 128) -> Heatmap:
+    """
+    Coarsest power-of-two column decimation that keeps at least `min_columns`
+    columns and whose maximum lesion depth stays within `max_depth_error` of the
+    full-resolution maximum (default: 2% of it).
+    """
+    z_max = float(np.max(hm.z)) if hm.z.size else 0.0
+    if max_depth_error is None:
+        max_depth_error = 0.02 * abs(z_max)
+    best = hm
+    factor = 2
+    while -(-hm.z.shape[1] // factor) >= min_columns:
+        lod = decimate_columns(hm, factor)
+        if abs(z_max - float(np.max(lod.z))) > max_depth_error:
+            break
+        best = lod
+        factor *= 2
+    return best
+
+
+# ===== PLOTLY =====
+def heatmap_figure(hm: Heatmap):
+    """Build the 3D topography figure (single `surface` trace) from a heatmap."""
+    import plotly.graph_objects as go
+
+    surface = go.Surface(
+        x=hm.x, y=hm.y, z=np.asarray(hm.z),
+        colorscale=hm.colorscale,
+        hovertemplate=hm.hovertemplate,
+    )
+    return go.Figure(data=[surface], layout=hm.layout)
+
+
+# Same look as the bundled exports
+DEPTH_COLORSCALE = [[0.0, "rgb(0,0,131)"], [0.2, "rgb(0,60,170)"], [0.4, "rgb(5,255,255)"],
+                    [0.6, "rgb(255,255,0)"], [0.8, "rgb(250,0,0)"], [1.0, "rgb(128,0,0)"]]
+
+
+def heatmap_from_depth(depth_um: np.ndarray, x_um: np.ndarray, y_um: np.ndarray) -> Heatmap:
+    """Heatmap (µm on every axis) from a segmented (n_slices, W) depth map, styled like the exports."""
+    depth_um = np.asarray(depth_um, dtype=np.float32)
+    z_max = float(depth_um.max()) if depth_um.size else 0.0
+    axis_title = lambda text: {"title": {"text": text, "font": {"size": 5}}}
+    layout = {
+        "template": {},
+        "title": {"text": "3D topography"},
+        "scene": {
+            "xaxis": axis_title("Length (µm)"),
+            "yaxis": axis_title("Width (µm)"),
+            "zaxis": dict(axis_title("Depth (µm)"), autorange=False, range=[z_max, 0.0]),
+            "aspectmode": "manual",
+            "aspectratio": {"x": 1.2, "y": 1, "z": 0.2},
+            "camera": {"eye": {"x": 1.5, "y": 1.5, "z": 0.3}, "up": {"x": 0, "y": 0, "z": 1}},
+        },
+    }
+    return Heatmap(z=depth_um, x=np.asarray(x_um, dtype=np.float64), y=np.asarray(y_um, dtype=np.float64),
+                   colorscale=DEPTH_COLORSCALE, hovertemplate="Depth: %{z:.2f} µm<extra></extra>",
+                   layout=layout, units_um={"x_unit_um": 1.0, "y_unit_um": 1.0, "z_unit_um": 1.0})
+
+
+def heatmap_from_plotly_json(json_path: Path) -> Heatmap:
+    """Read a Plotly figure export holding a single `surface` trace."""
+    with open(json_path, "r") as f:
+        fig = json.load(f)
+    traces = [t for t in fig.get("data", []) if t.get("type") == "surface"]
+    if len(traces) != 1:
+        raise ValueError(f"{Path(json_path).name}: expected exactly one surface trace, found {len(traces)}")
+    trace = traces[0]
+
+    z = np.asarray(trace["z"], dtype=np.float32)
+    x = np.asarray(trace["x"], dtype=np.float64)
+    y = np.asarray(trace["y"], dtype=np.float64)
+    # Exports store full meshgrids; keep only the axis vectors
+    if x.ndim == 2:
+        if not np.allclose(x, x[:1]):
+            raise ValueError(f"{Path(json_path).name}: x grid is not separable")
+        x = x[0]
+    if y.ndim == 2:
+        if not np.allclose(y, y[:, :1]):
+            raise ValueError(f"{Path(json_path).name}: y grid is not separable")
+        y = y[:, 0]
+
+    return Heatmap(
+        z=z, x=x, y=y,
+        colorscale=trace.get("colorscale"),
+        hovertemplate=trace.get("hovertemplate"),
+        layout=fig.get("layout") or {},
+    )
+
+
+def convert_json_dir(json_dir: Path, out_dir: Path) -> List[Path]:
+    """Convert every Plotly JSON export in `json_dir` to the binary format in `out_dir`."""
+    written = []
+    for json_path in sorted(Path(json_dir).glob("*.json")):
+        hm = heatmap_from_plotly_json(json_path)
+        written.append(save_heatmap(hm, Path(out_dir) / json_path.stem))
+    return written
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m oct_pipeline.heatmaps <json_dir> <out_dir>")
+    for npy in convert_json_dir(Path(sys.argv[1]), Path(sys.argv[2])):
+        _, meta = heatmap_paths(npy)
+        size = os.path.getsize(npy) + os.path.getsize(meta)
+        print(f"{npy.stem}: {size / 1024:.0f} KiB")
@@ -0,0 +1,279 @@
+# oct_pipeline/ingest.py
+# Background ingestion of uploaded acquisitions into images/.
+#
+# An upload (a .zip of B-scans, or the B-scans themselves) is identified by the
+# sha256 of its content and geometry. IngestManager.submit() returns the
+# existing job when the same acquisition is already queued, running or
+# ingested, so two people uploading the same case trigger one computation.
+#
+# A job runs on a worker thread and never touches Streamlit:
+#   extract    members are decoded one at a time (a bad slice, or two B-scans with
+#              one file name, fail the job early) and written to a staging folder,
+#              images/.ingest/<sha256>/
+#   previews   WebP previews, sprite and tiles into oct_segmentation_previews<N>/
+#   segment    depth profiles streamed slice by slice, volume accumulated
+#   heatmap    depth map saved to heatmaps_npy/3d_heatmap<N> (µm units)
+# The staging folder is renamed to oct_segmentation<N>/ last, so the registry
+# never indexes a half-processed case. A marker file in it (INGEST_MARKER)
+# records the upload hash, so re-uploads are recognised after a restart too.
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from . import heatmaps
+from .cli import uniform_slices
+from .previews import ALLOWED_EXTS, build_previews
+from .registry import CASE_DIR_RE, heatmap_stem
+from .segmentation import SegmentationParams
+from .volume import VolumeAccumulator, iter_depth_profiles, scan_spacing_um
+
+STAGING_DIR_NAME = ".ingest"
+INGEST_MARKER = ".ingest.json"
+
+# Share of the progress bar given to each stage
+_STAGE_WEIGHTS = {"extract": 0.3, "previews": 0.3, "segment": 0.35, "heatmap": 0.05}
+
+
+@dataclass
+class Upload:
+    name: str
+    data: bytes
+
+
+@dataclass
+class Geometry:
+    scan_length_um: float
+    pixel_width_um: float
+    pixel_depth_um: float
+
+
+@dataclass
+class IngestJob:
+    digest: str
+    case_id: int
+    label: str                       # upload name(s), for display
+    status: str = "queued"           # queued | running | done | failed
+    stage: str = ""
+    progress: float = 0.0            # 0..1 over all stages
+    n_slices: int = 0
+    volume_ul: Optional[float] = None
+    error: Optional[str] = None
+    submitted: float = field(default_factory=time.time)
+    finished: Optional[float] = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+
+def upload_digest(uploads: Sequence[Upload], geometry: Geometry) -> str:
+    """
+    Hash of an acquisition and the geometry it is processed with, independent
+    of upload order. A zip counts by its bytes only (the same archive renamed
+    is the same acquisition); loose slices also by name, since names give the
+    slice order. The same scans with a corrected geometry are a new job.
+    """
+    parts = sorted(("" if up.name.lower().endswith(".zip") else Path(up.name).name,
+                    hashlib.sha256(up.data).hexdigest()) for up in uploads)
+    return hashlib.sha256(json.dumps([parts, vars(geometry)], sort_keys=True).encode()).hexdigest()
+
+
+def _is_slice_name(name: str) -> bool:
+    return not name.startswith(".") and os.path.splitext(name)[1].lower() in ALLOWED_EXTS
+
+
+def _zip_members(zf: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    return sorted((i for i in zf.infolist() if not i.is_dir() and _is_slice_name(PurePosixPath(i.filename).name)),
+                  key=lambda i: i.filename)
+
+
+def slice_names(uploads: Sequence[Upload]) -> List[str]:
+    """
+    File names of the B-scans in the uploads (zip central directories only,
+    nothing decompressed). Zip members are stored under their base name, so
+    two B-scans with one name (e.g. in different folders of a zip) would
+    overwrite each other: ValueError.
+    """
+    origins: Dict[str, str] = {}
+    for up in uploads:
+        if up.name.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(up.data)) as zf:
+                members = [(PurePosixPath(i.filename).name, f"{up.name}:{i.filename}") for i in _zip_members(zf)]
+        elif _is_slice_name(Path(up.name).name):
+            members = [(Path(up.name).name, up.name)]
+        else:
+            members = []
+        for name, origin in members:
+            if name in origins:
+                raise ValueError(f"two B-scans named {name} in the upload ({origins[name]}, {origin})")
+            origins[name] = origin
+    return list(origins)
+
+
+def count_slices(uploads: Sequence[Upload]) -> int:
+    """Number of B-scans in the uploads (see slice_names)."""
+    return len(slice_names(uploads))
+
+
+def iter_slices(uploads: Sequence[Upload]) -> Iterator[Tuple[str, bytes]]:
+    """(file name, bytes) of every B-scan in the uploads, zip members decompressed one at a time."""
+    for up in uploads:
+        if up.name.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(up.data)) as zf:
+                for info in _zip_members(zf):
+                    yield PurePosixPath(info.filename).name, zf.read(info)
+        elif _is_slice_name(Path(up.name).name):
+            yield Path(up.name).name, up.data
+
+
+def ingested_geometry(case_dir: Path) -> Optional[Geometry]:
+    """Geometry an ingested case was uploaded with (from its marker), None for other cases."""
+    try:
+        with open(Path(case_dir) / INGEST_MARKER, "r") as f:
+            return Geometry(**json.load(f)["geometry"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+class IngestManager:
+    """Queue of ingestion jobs for one images/ directory, processed by background threads."""
+
+    def __init__(self, images_dir: Path, workers: int = 1,
+                 params: SegmentationParams = SegmentationParams(), first_case_id: int = 1,
+                 max_dim: int = 600, quality: int = 70, tile_size: Optional[int] = None):
+        self.images_dir = Path(images_dir)
+        self.params = params
+        # Preview parameters: the ones the app's gallery uses, or its previews are rendered twice
+        self.preview_params = {"max_dim": max_dim, "quality": quality, "tile_size": tile_size}
+        self.first_case_id = first_case_id   # ids below are reserved (e.g. cases with curated extras)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, IngestJob] = {}
+        self._reserved: List[int] = []
+        self._load_markers()
+
+    def _load_markers(self) -> None:
+        if not self.images_dir.exists():
+            return
+        for entry in os.scandir(self.images_dir):
+            m = CASE_DIR_RE.match(entry.name)
+            if not (m and entry.is_dir()):
+                continue
+            try:
+                with open(Path(entry.path) / INGEST_MARKER, "r") as f:
+                    marker = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self._jobs[marker["digest"]] = IngestJob(
+                digest=marker["digest"], case_id=int(m.group(1)), label=marker.get("label", entry.name),
+                status="done", stage="done", progress=1.0, n_slices=marker.get("n_slices", 0),
+                volume_ul=marker.get("volume_ul"), finished=marker.get("finished"))
+
+    def _next_case_id(self) -> int:
+        used = set(self._reserved)
+        if self.images_dir.exists():
+            for entry in os.scandir(self.images_dir):
+                m = CASE_DIR_RE.match(entry.name)
+                if m:
+                    used.add(int(m.group(1)))
+        case_id = max(max(used, default=0) + 1, self.first_case_id)
+        self._reserved.append(case_id)
+        return case_id
+
+    # ===== API =====
+    def submit(self, uploads: Sequence[Upload], geometry: Geometry) -> IngestJob:
+        """Queue an acquisition; returns the existing job if the same content is in flight or done."""
+        digest = upload_digest(uploads, geometry)
+        with self._lock:
+            job = self._jobs.get(digest)
+            if job is not None and job.status != "failed":
+                return job
+            job = IngestJob(digest=digest, case_id=self._next_case_id(),
+                            label=", ".join(sorted(u.name for u in uploads)))
+            self._jobs[digest] = job
+        self._pool.submit(self._run, job, list(uploads), geometry)
+        return job
+
+    def jobs(self) -> List[IngestJob]:
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.submitted)
+
+    # ===== WORKER =====
+    def _advance(self, job: IngestJob, stage: str, fraction: float) -> None:
+        done = 0.0
+        for name, weight in _STAGE_WEIGHTS.items():
+            if name == stage:
+                break
+            done += weight
+        job.stage = stage
+        job.progress = min(1.0, done + _STAGE_WEIGHTS[stage] * fraction)
+
+    def _run(self, job: IngestJob, uploads: List[Upload], geometry: Geometry) -> None:
+        job.status = "running"
+        staging = self.images_dir / STAGING_DIR_NAME / job.digest
+        try:
+            self._ingest(job, uploads, geometry, staging)
+            job.status, job.stage, job.progress = "done", "done", 1.0
+        except Exception:
+            job.status = "failed"
+            job.error = traceback.format_exc(limit=3).strip().splitlines()[-1]
+            shutil.rmtree(staging, ignore_errors=True)
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                if job.case_id in self._reserved:
+                    self._reserved.remove(job.case_id)
+
+    def _ingest(self, job: IngestJob, uploads: List[Upload], geometry: Geometry, staging: Path) -> None:
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+
+        # Extract: decode each slice once to validate it before anything is computed
+        total = count_slices(uploads)
+        if not total:
+            raise ValueError("no .tif/.tiff/.png/.jpg B-scans in the upload")
+        for i, (name, data) in enumerate(iter_slices(uploads)):
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+            (staging / name).write_bytes(data)
+            self._advance(job, "extract", (i + 1) / total)
+        paths, (width, _) = uniform_slices(sorted(staging.iterdir(), key=lambda p: p.name))
+        job.n_slices = len(paths)
+
+        prev_dir = self.images_dir / f"oct_segmentation_previews{job.case_id}"
+        self._advance(job, "previews", 0.0)
+        build_previews(staging, prev_dir, workers=1, **self.preview_params)   # no pool from a thread
+
+        spacing = scan_spacing_um(geometry.scan_length_um, len(paths))
+        acc = VolumeAccumulator(spacing, geometry.pixel_width_um, geometry.pixel_depth_um)
+        depth_um = np.empty((len(paths), width), dtype=np.float32)
+        for i, profile in enumerate(iter_depth_profiles(paths, self.params)):
+            acc.add(profile)
+            depth_um[i] = profile * geometry.pixel_depth_um
+            self._advance(job, "segment", (i + 1) / len(paths))
+        job.volume_ul = acc.volume_ul
+
+        self._advance(job, "heatmap", 0.0)
+        hm = heatmaps.heatmap_from_depth(depth_um, np.arange(width) * geometry.pixel_width_um,
+                                         np.arange(len(paths)) * spacing)
+        heatmaps.save_heatmap(hm, self.images_dir / "heatmaps_npy" / heatmap_stem(job.case_id))
+
+        with open(staging / INGEST_MARKER, "w") as f:
+            json.dump({"digest": job.digest, "label": job.label, "n_slices": job.n_slices,
+                       "volume_ul": job.volume_ul, "finished": time.time(),
+                       "geometry": vars(geometry)}, f, indent=1)
+        os.rename(staging, self.images_dir / f"oct_segmentation{job.case_id}")
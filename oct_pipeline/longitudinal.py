@@ -0,0 +1,192 @@
+# oct_pipeline/longitudinal.py
+# Follow-up of a lesion across visits: registration of depth maps by FFT phase
+# correlation, difference map, volume change and healing rate.
+#
+# Visits may have different scan counts, column counts and units, so every map
+# is first resampled (separable linear interpolation, see enface) onto one
+# isotropic µm grid, zero (healthy) outside its own acquisition. The
+# translation of each follow-up relative to the baseline is the peak of the
+# normalized cross-power spectrum, refined to sub-pixel by a parabola through
+# the peak and its neighbours. All follow-ups go through one batched real FFT
+# over a (k, H, W) stack, zero-padded to twice the grid so that circular
+# wrap-around never aligns opposite edges. Maps are tapered (Tukey window)
+# first: ulcers often reach the border of the scan, and the step there would
+# otherwise pin the correlation peak at zero shift.
+
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import fft, ndimage
+from scipy.signal.windows import tukey
+
+from .enface import interpolate_axis
+from .heatmaps import Heatmap, heatmap_figure
+from .volume import surface_volume
+
+MAX_GRID = 512          # samples along the longest axis of the common grid
+TAPER = 0.5             # Tukey window fraction applied before the FFT
+
+# Diverging: shallower than at baseline (blue) / unchanged (white) / deeper (red)
+DIFFERENCE_COLORSCALE = [[0.0, "rgb(33,102,172)"], [0.25, "rgb(146,197,222)"], [0.5, "rgb(247,247,247)"],
+                         [0.75, "rgb(244,165,130)"], [1.0, "rgb(178,24,43)"]]
+
+_UM = {"x_unit_um": 1.0, "y_unit_um": 1.0, "z_unit_um": 1.0}
+
+
+@dataclass
+class Registration:
+    shift_um: Tuple[float, float]   # (dy, dx) moving the follow-up onto the baseline
+    peak: float                     # height of the correlation peak (1 = identical up to a shift)
+
+
+@dataclass
+class VisitComparison:
+    followup: Heatmap               # follow-up depth map (µm), aligned on the baseline grid
+    difference: Heatmap             # follow-up minus baseline depth (µm); negative where it healed
+    registration: Registration
+    volume_baseline_ul: float
+    volume_followup_ul: float
+
+    @property
+    def volume_delta_ul(self) -> float:
+        return self.volume_followup_ul - self.volume_baseline_ul
+
+    @property
+    def volume_change(self) -> float:
+        """Relative volume change since baseline (-1 = fully healed)."""
+        return self.volume_delta_ul / self.volume_baseline_ul if self.volume_baseline_ul else float("nan")
+
+    def healing_rate_ul_per_day(self, days: float) -> float:
+        """Volume recovered per day over `days` between the visits (negative if the lesion grew)."""
+        return -self.volume_delta_ul / days if days > 0 else float("nan")
+
+
+# ===== COMMON GRID =====
+def _axes_um(hm: Heatmap):
+    units = hm.axis_units_um()
+    x = np.asarray(hm.x, dtype=np.float64) * units["x_unit_um"]
+    y = np.asarray(hm.y, dtype=np.float64) * units["y_unit_um"]
+    return x, y, units["z_unit_um"]
+
+
+def grid_step_um(maps: Sequence[Heatmap], max_grid: int = MAX_GRID) -> float:
+    """Finest column spacing of the maps, coarsened so the largest extent fits in `max_grid` samples."""
+    steps, extents = [], []
+    for hm in maps:
+        x, y, _ = _axes_um(hm)
+        steps.append(np.ptp(x) / max(len(x) - 1, 1))
+        extents += [np.ptp(x), np.ptp(y)]
+    return max(min(steps), max(extents) / (max_grid - 1))
+
+
+def resample_um(maps: Sequence[Heatmap], step_um: float) -> np.ndarray:
+    """(k, H, W) float32 stack of the depth maps in µm on a shared grid of `step_um`, origin at each map's corner."""
+    sizes = []
+    for hm in maps:
+        x, y, _ = _axes_um(hm)
+        sizes.append((int(np.ptp(y) / step_um) + 1, int(np.ptp(x) / step_um) + 1))
+    h, w = (max(s) for s in zip(*sizes))
+    stack = np.zeros((len(maps), h, w), dtype=np.float32)
+    for i, (hm, (ny, nx)) in enumerate(zip(maps, sizes)):
+        x, y, z_unit = _axes_um(hm)
+        z = np.nan_to_num(np.asarray(hm.z, dtype=np.float32), nan=0.0) * np.float32(z_unit)
+        z = interpolate_axis(z, y, y.min() + np.arange(ny) * step_um, "linear", axis=0)
+        stack[i, :ny, :nx] = interpolate_axis(z, x, x.min() + np.arange(nx) * step_um, "linear", axis=1)
+    return stack
+
+
+# ===== REGISTRATION =====
+def phase_correlation(reference: np.ndarray, moving: np.ndarray,
+                      taper: float = TAPER) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Translation (dy, dx) in samples of each (H, W) map of `moving` (k, H, W)
+    relative to `reference`, and the correlation peak height. Shifting a map
+    by -(dy, dx) aligns it on the reference.
+    """
+    moving = np.asarray(moving, dtype=np.float32)
+    if moving.ndim == 2:
+        moving = moving[None]
+    h, w = reference.shape
+    window = np.outer(tukey(h, taper), tukey(w, taper)).astype(np.float32)
+    shape = (2 * h, 2 * w)
+    f_ref = fft.rfft2(reference * window, s=shape)
+    f_mov = fft.rfft2(moving * window, s=shape, axes=(-2, -1))
+    cross = f_mov * np.conj(f_ref)
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    corr = fft.irfft2(cross, s=shape, axes=(-2, -1))          # (k, 2H, 2W)
+
+    k = len(moving)
+    flat = corr.reshape(k, -1).argmax(axis=1)
+    py, px = np.unravel_index(flat, shape)
+    rows = np.arange(k)
+    peak = corr[rows, py, px]
+
+    def refine(before, after):
+        denom = before - 2 * peak + after
+        ok = np.abs(denom) > 1e-12
+        return np.where(ok, 0.5 * (before - after) / np.where(ok, denom, 1.0), 0.0)
+
+    dy = py + refine(corr[rows, (py - 1) % shape[0], px], corr[rows, (py + 1) % shape[0], px])
+    dx = px + refine(corr[rows, py, (px - 1) % shape[1]], corr[rows, py, (px + 1) % shape[1]])
+    # Peaks past the middle are negative shifts
+    dy = np.where(dy > shape[0] / 2, dy - shape[0], dy)
+    dx = np.where(dx > shape[1] / 2, dx - shape[1], dx)
+    return np.stack([dy, dx], axis=1), peak.astype(np.float64)
+
+
+# ===== COMPARISON =====
+def compare_visits(baseline: Heatmap, followups: Sequence[Heatmap], max_grid: int = MAX_GRID) -> List[VisitComparison]:
+    """Register every follow-up on the baseline (one batched FFT) and compare depth and volume."""
+    if not followups:
+        return []
+    step = grid_step_um([baseline, *followups], max_grid)
+    stack = resample_um([baseline, *followups], step)
+    ref, moving = stack[0], stack[1:]
+    shifts, peaks = phase_correlation(ref, moving)
+
+    h, w = ref.shape
+    x = np.arange(w) * step
+    y = np.arange(h) * step
+    volume_baseline = surface_volume(x, y, ref).volume_ul
+    out = []
+    for z, shift, peak in zip(moving, shifts, peaks):
+        aligned = ndimage.shift(z, -shift, order=1, mode="constant", cval=0.0)
+        np.maximum(aligned, 0.0, out=aligned)
+        diff = aligned - ref
+        out.append(VisitComparison(
+            followup=Heatmap(z=aligned, x=x, y=y, colorscale=baseline.colorscale,
+                             hovertemplate="Depth: %{z:.2f} µm<extra></extra>", units_um=_UM),
+            difference=difference_heatmap(diff, x, y),
+            registration=Registration(shift_um=(float(-shift[0] * step), float(-shift[1] * step)), peak=float(peak)),
+            volume_baseline_ul=volume_baseline,
+            volume_followup_ul=surface_volume(x, y, z).volume_ul,   # before the shift crops anything
+        ))
+    return out
+
+
+def difference_heatmap(diff_um: np.ndarray, x_um: np.ndarray, y_um: np.ndarray) -> Heatmap:
+    """Difference topography (µm), styled like the depth maps with a diverging colorscale."""
+    axis_title = lambda text: {"title": {"text": text, "font": {"size": 5}}}
+    layout = {
+        "template": {},
+        "title": {"text": "Depth change since baseline"},
+        "scene": {
+            "xaxis": axis_title("Length (µm)"),
+            "yaxis": axis_title("Width (µm)"),
+            "zaxis": dict(axis_title("Change (µm)"), autorange="reversed"),
+            "aspectmode": "manual",
+            "aspectratio": {"x": 1.2, "y": 1, "z": 0.2},
+        },
+    }
+    return Heatmap(z=np.asarray(diff_um, dtype=np.float32), x=x_um, y=y_um, colorscale=DIFFERENCE_COLORSCALE,
+                   hovertemplate="Change: %{z:+.2f} µm<extra></extra>", layout=layout, units_um=_UM)
+
+
+def difference_figure(hm: Heatmap, limit_um: Optional[float] = None):
+    """3D difference topography, with the colour scale centred on no change."""
+    z = np.asarray(hm.z)
+    limit = limit_um if limit_um is not None else float(np.abs(z).max()) or 1.0
+    fig = heatmap_figure(hm)
+    fig.update_traces(cmin=-limit, cmax=limit)
+    return fig
@@ -0,0 +1,157 @@
+# oct_pipeline/mesh.py
+# Watertight triangle mesh of a lesion, for bioprinting: binary STL and PLY in µm.
+#
+# The solid is the lesion cavity: its top is the healthy surface (the plane
+# z = base_um) and its floor is the depth map (z = -depth), closed by vertical
+# walls along the grid border. Every grid point gives one top and one floor
+# vertex; triangles come from index arithmetic on the (n, m) grid, with no
+# per-quad Python loop. Faces are written in chunks, so a large mesh never
+# needs its whole STL / PLY body in memory.
+#
+#   python -m oct_pipeline.mesh images/heatmaps_npy/3d_heatmap2.npy lesion2.stl
+
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Optional, Union
+
+import numpy as np
+
+from .heatmaps import Heatmap
+
+CHUNK_FACES = 1 << 16
+
+# Binary STL record: normal, 3 vertices, attribute byte count (50 bytes)
+_STL_FACE = np.dtype([("normal", "<f4", 3), ("v", "<f4", (3, 3)), ("attr", "<u2")])
+# Binary PLY face: vertex count, 3 indices (13 bytes)
+_PLY_FACE = np.dtype([("n", "u1"), ("v", "<i4", 3)])
+
+
+@dataclass
+class Mesh:
+    vertices: np.ndarray   # (V, 3) float32, µm
+    faces: np.ndarray      # (F, 3) int32 vertex indices, counter-clockwise seen from outside
+
+    @property
+    def n_faces(self) -> int:
+        return int(self.faces.shape[0])
+
+
+def _grid_quads(n: int, m: int) -> np.ndarray:
+    """(Q, 4) corner indices (i,j), (i,j+1), (i+1,j+1), (i+1,j) of every cell of an n x m grid."""
+    idx = np.arange(n * m, dtype=np.int32).reshape(n, m)
+    return np.stack([idx[:-1, :-1], idx[:-1, 1:], idx[1:, 1:], idx[1:, :-1]], axis=-1).reshape(-1, 4)
+
+
+def _perimeter(n: int, m: int) -> np.ndarray:
+    """Grid border indices, counter-clockwise (increasing j first) and closed."""
+    idx = np.arange(n * m, dtype=np.int32).reshape(n, m)
+    ring = np.concatenate([idx[0, :], idx[1:, -1], idx[-1, -2::-1], idx[-2:0:-1, 0]])
+    return np.append(ring, ring[0])
+
+
+def lesion_mesh(x_um: np.ndarray, y_um: np.ndarray, depth_um: np.ndarray, base_um: float = 0.0) -> Mesh:
+    """
+    Closed mesh between the plane z = base_um and the floor z = -depth_um,
+    for an (n, m) depth grid over n scan positions `y_um` and m columns `x_um`.
+    NaN depths are treated as healthy (0).
+    """
+    depth = np.nan_to_num(np.asarray(depth_um, dtype=np.float32), nan=0.0)
+    n, m = depth.shape
+    if n < 2 or m < 2:
+        raise ValueError(f"need at least a 2 x 2 depth grid, got {depth.shape}")
+    xx = np.broadcast_to(np.asarray(x_um, dtype=np.float32)[None, :], (n, m))
+    yy = np.broadcast_to(np.asarray(y_um, dtype=np.float32)[:, None], (n, m))
+    top = np.stack([xx, yy, np.full((n, m), base_um, dtype=np.float32)], axis=-1).reshape(-1, 3)
+    floor = np.stack([xx, yy, -depth], axis=-1).reshape(-1, 3)
+    vertices = np.concatenate([top, floor])
+    nv = n * m
+
+    q = _grid_quads(n, m)
+    top_faces = np.concatenate([q[:, [0, 1, 2]], q[:, [0, 2, 3]]])          # normal +z
+    floor_faces = np.concatenate([q[:, [0, 2, 1]], q[:, [0, 3, 2]]]) + nv    # normal -z
+    ring = _perimeter(n, m)
+    p, r = ring[:-1], ring[1:]
+    wall_faces = np.concatenate([np.stack([p, p + nv, r + nv], axis=-1),
+                                 np.stack([p, r + nv, r], axis=-1)])
+    faces = np.concatenate([top_faces, floor_faces, wall_faces]).astype(np.int32)
+
+    # Windings assume x and y both increase along the grid; one reversed axis mirrors them
+    dx = float(xx[0, -1] - xx[0, 0])
+    dy = float(yy[-1, 0] - yy[0, 0])
+    if dx * dy < 0:
+        faces = faces[:, ::-1].copy()
+    return Mesh(vertices=vertices, faces=faces)
+
+
+def heatmap_mesh(hm: Heatmap, base_um: float = 0.0) -> Mesh:
+    """Lesion mesh of a heatmap, with every axis converted to µm."""
+    units = hm.axis_units_um()
+    return lesion_mesh(np.asarray(hm.x, dtype=np.float64) * units["x_unit_um"],
+                       np.asarray(hm.y, dtype=np.float64) * units["y_unit_um"],
+                       np.asarray(hm.z, dtype=np.float32) * units["z_unit_um"], base_um)
+
+
+# ===== WRITERS =====
+def _open(target: Union[Path, BinaryIO]):
+    if hasattr(target, "write"):
+        return target, False
+    Path(target).parent.mkdir(parents=True, exist_ok=True)
+    return open(target, "wb"), True
+
+
+def write_stl(mesh: Mesh, target: Union[Path, BinaryIO], chunk_faces: int = CHUNK_FACES) -> None:
+    """Binary STL (units: µm); normals computed per chunk."""
+    f, owned = _open(target)
+    try:
+        f.write(b"oct_pipeline lesion mesh, units: micrometres".ljust(80, b" "))
+        f.write(np.uint32(mesh.n_faces).tobytes())
+        for start in range(0, mesh.n_faces, chunk_faces):
+            tri = mesh.vertices[mesh.faces[start:start + chunk_faces]]             # (k, 3, 3)
+            normal = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+            length = np.linalg.norm(normal, axis=1, keepdims=True)
+            rec = np.zeros(len(tri), dtype=_STL_FACE)
+            rec["normal"] = np.divide(normal, length, out=np.zeros_like(normal), where=length > 0)
+            rec["v"] = tri
+            f.write(rec.tobytes())
+    finally:
+        if owned:
+            f.close()
+
+
+def write_ply(mesh: Mesh, target: Union[Path, BinaryIO], chunk_faces: int = CHUNK_FACES) -> None:
+    """Binary little-endian PLY (units: µm)."""
+    f, owned = _open(target)
+    try:
+        header = ("ply\nformat binary_little_endian 1.0\ncomment units: micrometres\n"
+                  f"element vertex {len(mesh.vertices)}\nproperty float x\nproperty float y\nproperty float z\n"
+                  f"element face {mesh.n_faces}\nproperty list uchar int vertex_indices\nend_header\n")
+        f.write(header.encode("ascii"))
+        f.write(np.ascontiguousarray(mesh.vertices, dtype="<f4").tobytes())
+        for start in range(0, mesh.n_faces, chunk_faces):
+            faces = mesh.faces[start:start + chunk_faces]
+            rec = np.empty(len(faces), dtype=_PLY_FACE)
+            rec["n"] = 3
+            rec["v"] = faces
+            f.write(rec.tobytes())
+    finally:
+        if owned:
+            f.close()
+
+
+def write_mesh(mesh: Mesh, path: Path, fmt: Optional[str] = None) -> Path:
+    """STL or PLY, from `fmt` or the file extension."""
+    fmt = (fmt or Path(path).suffix.lstrip(".")).lower()
+    writers = {"stl": write_stl, "ply": write_ply}
+    if fmt not in writers:
+        raise ValueError(f"unsupported mesh format {fmt!r} (use .stl or .ply)")
+    writers[fmt](mesh, path)
+    return Path(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m oct_pipeline.mesh <heatmap .npy|.json> <out .stl|.ply>")
+    from .registry import load_depth_map
+    out = write_mesh(heatmap_mesh(load_depth_map(Path(sys.argv[1]))), Path(sys.argv[2]))
+    print(f"{out}: {out.stat().st_size / 1024:.0f} KiB")
@@ -0,0 +1,162 @@
+# oct_pipeline/metrics.py
+# Lightweight in-process instrumentation: stage timers, counters and their export.
+#
+# METRICS is one process-wide registry, safe to use from several threads
+# (Streamlit runs each session's script in its own thread):
+#   with METRICS.timer("stage_seconds", stage="build_previews"): ...
+#   METRICS.inc("payload_bytes_total", n, kind="image")
+# Totals accumulate for the life of the process and export as Prometheus text
+# (to_prometheus / write_textfile, e.g. for node_exporter's textfile collector)
+# or JSON (snapshot). Between begin_run() and end_run(), everything recorded on
+# the calling thread is also collected into a RunRecord, i.e. one app rerun.
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _run_key(name: str, labels: Labels) -> str:
+    # stage_seconds{stage="build_previews"} -> "stage/build_previews", compact enough for a table
+    for suffix in ("_seconds", "_total"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return "/".join([name] + [v for _, v in labels])
+
+
+@dataclass
+class RunRecord:
+    """Everything one thread recorded between begin_run() and end_run()."""
+    started: float = field(default_factory=time.perf_counter)
+    seconds: Optional[float] = None                        # wall time, set by end_run()
+    timings: Dict[str, float] = field(default_factory=dict)
+    counters: Dict[str, float] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {"seconds": self.seconds, "timings": self.timings, "counters": self.counters}
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._timers: Dict[Tuple[str, Labels], List[float]] = {}   # [count, sum, max]
+        self._local = threading.local()
+
+    # ===== RECORDING =====
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+        run = self.current_run()
+        if run is not None:
+            k = _run_key(*key)
+            run.counters[k] = run.counters.get(k, 0.0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            t = self._timers.setdefault(key, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+        run = self.current_run()
+        if run is not None:
+            k = _run_key(*key)
+            run.timings[k] = run.timings.get(k, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t, **labels)
+
+    # ===== PER-RUN =====
+    def begin_run(self) -> RunRecord:
+        run = RunRecord()
+        self._local.run = run
+        return run
+
+    def current_run(self) -> Optional[RunRecord]:
+        return getattr(self._local, "run", None)
+
+    def end_run(self) -> Optional[RunRecord]:
+        """Close the calling thread's run, log it as one JSON line and count it."""
+        run = self.current_run()
+        self._local.run = None
+        if run is None:
+            return None
+        run.seconds = time.perf_counter() - run.started
+        self.observe("run_seconds", run.seconds)
+        log.info(json.dumps({"event": "run", **run.to_dict()}, sort_keys=True))
+        return run
+
+    # ===== EXPORT =====
+    def snapshot(self) -> dict:
+        """JSON-ready copy of every counter and timer."""
+        with self._lock:
+            counters = [{"name": n, "labels": dict(lb), "value": v} for (n, lb), v in self._counters.items()]
+            timers = [{"name": n, "labels": dict(lb), "count": t[0], "sum": t[1], "max": t[2]}
+                      for (n, lb), t in self._timers.items()]
+        return {"counters": counters, "timers": timers}
+
+    def to_prometheus(self, prefix: str = "oct_") -> str:
+        """Prometheus text exposition format: counters as counters, timers as summaries (+ a _max gauge)."""
+        def fmt(labels: Labels) -> str:
+            if not labels:
+                return ""
+            esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted(self._timers.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {prefix}{name} counter")
+                typed.add(name)
+            lines.append(f"{prefix}{name}{fmt(labels)} {value:.15g}")
+        # Each metric family must be contiguous, so the _max gauges follow their summary
+        for family in sorted({name for (name, _), _ in timers}):
+            samples = [(labels, t) for (name, labels), t in timers if name == family]
+            lines.append(f"# TYPE {prefix}{family} summary")
+            for labels, (count, total, _) in samples:
+                lines.append(f"{prefix}{family}_count{fmt(labels)} {count:d}")
+                lines.append(f"{prefix}{family}_sum{fmt(labels)} {total:.6f}")
+            lines.append(f"# TYPE {prefix}{family}_max gauge")
+            for labels, (_, _, peak) in samples:
+                lines.append(f"{prefix}{family}_max{fmt(labels)} {peak:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: Path) -> None:
+        """Atomically (re)write the Prometheus text to `path`."""
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+
+METRICS = Metrics()
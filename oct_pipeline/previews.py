@@ -0,0 +1,369 @@
+# oct_pipeline/previews.py
+# WebP preview generation for the slice galleries.
+#
+# Each preview directory carries a small manifest (MANIFEST_NAME) recording,
+# per source slice, its size / mtime, content hash and the preview parameters
+# it was rendered with. A warm start is one directory scan plus one manifest
+# read; only slices whose content or preview parameters changed are re-rendered,
+# and those are decoded / resized / encoded in parallel across a process pool.
+
+import atexit
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from .disk_cache import DiskCache, cache_key, temp_path
+from .tiles import build_pyramid, pyramid_dir
+from .volume_store import open_volume, packed_frames, read_volume_meta
+
+try:
+    import fcntl   # POSIX: serializes preview builds between processes
+except ImportError:   # pragma: no cover - Windows
+    fcntl = None
+
+ALLOWED_EXTS = (".tif", ".tiff", ".png", ".jpg", ".jpeg")
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+SPRITE_NAME = "sprite.webp"        # all thumbnails of a case packed into one image
+SPRITE_META_NAME = "sprite.json"   # grid layout of the sprite + the key it was built for
+TILES_DIR_NAME = "tiles"           # per-slice tile pyramids (see tiles.py)
+
+# Below this many stale previews the process pool costs more than it saves
+MIN_PARALLEL_JOBS = 4
+LOCK_NAME = ".lock"                # flock target of folder_lock()
+
+
+def list_source_slices(seg_dir: Path) -> List[Path]:
+    """Source B-scans of a case, sorted by name."""
+    if not seg_dir.exists():
+        return []
+    files = [Path(e.path) for e in os.scandir(seg_dir)
+             if e.is_file() and os.path.splitext(e.name)[1].lower() in ALLOWED_EXTS]
+    files.sort(key=lambda p: p.name)
+    return files
+
+
+def preview_path(src: Path, prev_dir: Path) -> Path:
+    # One-to-one mapping: <name>.webp
+    return prev_dir / (src.stem + ".webp")
+
+
+# ===== MANIFEST =====
+def read_manifest(prev_dir: Path) -> Dict[str, dict]:
+    try:
+        with open(prev_dir / MANIFEST_NAME, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if data.get("version") != MANIFEST_VERSION:
+        return {}
+    return data.get("entries", {})
+
+
+def write_manifest(prev_dir: Path, entries: Dict[str, dict]) -> None:
+    tmp = temp_path(prev_dir / MANIFEST_NAME)
+    with open(tmp, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "entries": entries}, f, indent=1, sort_keys=True)
+    os.replace(tmp, prev_dir / MANIFEST_NAME)
+
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# ===== RENDERING =====
+def render_preview(src: Path, dest: Path, max_dim: int, quality: int,
+                   tile_size: Optional[int] = None) -> str:
+    """
+    Decode one slice, downscale it and write it as WebP; with `tile_size`, also
+    cut the native-resolution image into a tile pyramid from the same decode.
+    Returns the source's content hash (computed from the bytes that were decoded).
+    Module-level so it can run in a worker process.
+    """
+    data = Path(src).read_bytes()
+    img = Image.open(io.BytesIO(data))
+
+    # Multi-frame TIFF: the preview shows the first frame (volume_store packs them all)
+    if getattr(img, "n_frames", 1) > 1:
+        try:
+            img.seek(0)
+        except Exception:
+            pass
+
+    # Fix orientation, convert to RGB
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    write_preview(img, Path(src).stem, dest, max_dim, quality, tile_size)
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_preview(img: Image.Image, stem: str, dest: Path, max_dim: int, quality: int,
+                  tile_size: Optional[int] = None) -> None:
+    """Tile pyramid (optional) + downscaled WebP preview of an already decoded slice."""
+    if tile_size:
+        build_pyramid(img, pyramid_dir(Path(stem), Path(dest).parent / TILES_DIR_NAME), tile_size, quality)
+
+    # Downscale (keeps aspect ratio)
+    img = img.copy()
+    img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+
+    # Write next to the destination and rename, so readers never see half a file
+    tmp = temp_path(dest)
+    img.save(tmp, format="WEBP", quality=quality, method=0)
+    os.replace(tmp, dest)
+
+
+def _volume_frames(volume: Optional[Path], srcs: List[Path]) -> Dict[str, Tuple[int, str]]:
+    """
+    {source name: (first frame index, sha256)} of the sources that an
+    up-to-date, grayscale `volume` holds; their previews skip the PIL decode.
+    Other sources (strays left out of the pack, slices added since) and colour
+    packs (e.g. contour overlays) keep being rendered from the files.
+    """
+    if volume is None:
+        return {}
+    meta = read_volume_meta(volume)
+    if meta is None or not meta.get("grayscale"):
+        return {}
+    return packed_frames(volume, srcs)
+
+
+_folder_locks: Dict[str, threading.Lock] = {}
+_folder_locks_guard = threading.Lock()
+
+
+@contextmanager
+def folder_lock(folder: Path):
+    """Exclusive lock on a preview folder, across threads (in-process lock) and processes (flock)."""
+    with _folder_locks_guard:
+        local = _folder_locks.setdefault(os.path.abspath(folder), threading.Lock())
+    with local, open(Path(folder) / LOCK_NAME, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _pool_context():
+    # Callers include the multi-threaded Streamlit server: never fork() a threaded process
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_guard = threading.Lock()
+
+
+def _render_pool(n_workers: int) -> ProcessPoolExecutor:
+    """
+    Process pool shared by every build_previews call of this process. Workers
+    of a forkserver / spawn pool start a fresh interpreter, so they are started
+    once and reused; the pool is only replaced for another size or after a
+    worker died (see _discard_render_pool).
+    """
+    global _pool, _pool_workers
+    with _pool_guard:
+        if _pool is None or _pool_workers != n_workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=_pool_context())
+            _pool_workers = n_workers
+        return _pool
+
+
+def _discard_render_pool(pool: ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_guard:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+@atexit.register
+def _shutdown_render_pool() -> None:
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+
+
+def _render_job(job: Tuple[str, str, int, int, Optional[int]]) -> str:
+    src, dest, max_dim, quality, tile_size = job
+    return render_preview(Path(src), Path(dest), max_dim, quality, tile_size)
+
+
+# ===== BUILD =====
+def build_previews(seg_dir: Path, prev_dir: Path, max_dim: int = 1000, quality: int = 80,
+                   workers: Optional[int] = None, sprite: bool = True,
+                   tile_size: Optional[int] = None, volume: Optional[Path] = None) -> List[Path]:
+    """
+    Ensure every source image has an up-to-date WebP preview; return the sorted
+    list of preview paths. Previews are regenerated when the source content or
+    (max_dim, quality, tile_size) changed, in parallel over `workers` processes.
+    With `sprite`, the case's thumbnail sprite sheet is kept up to date as well;
+    with `tile_size`, every slice also gets a tile pyramid under prev_dir/tiles/.
+    With `volume` (a grayscale pack, see volume_store), stale previews of the
+    sources it holds unchanged are rendered straight from the memory-mapped
+    frames; the others are decoded from their files.
+    """
+    prev_dir.mkdir(parents=True, exist_ok=True)
+    # One builder per folder at a time (sessions, the prefetch thread, ingest jobs, other
+    # processes); the next one finds the previews fresh and only re-reads the manifest
+    with folder_lock(prev_dir):
+        return _build_previews(seg_dir, prev_dir, max_dim, quality, workers, sprite, tile_size, volume)
+
+
+def _build_previews(seg_dir: Path, prev_dir: Path, max_dim: int, quality: int, workers: Optional[int],
+                    sprite: bool, tile_size: Optional[int], volume: Optional[Path]) -> List[Path]:
+    srcs = list_source_slices(seg_dir)
+    manifest = read_manifest(prev_dir)
+    existing = {e.name for e in os.scandir(prev_dir)}
+
+    entries: Dict[str, dict] = {}
+    jobs: List[Tuple[str, str, int, int, Optional[int]]] = []
+    for src in srcs:
+        dest = preview_path(src, prev_dir)
+        st = src.stat()
+        entry = manifest.get(src.name)
+        fresh = (
+            entry is not None
+            and dest.name in existing
+            and entry.get("max_dim") == max_dim
+            and entry.get("quality") == quality
+            and entry.get("tile_size") == tile_size
+        )
+        if fresh and (entry["size"], entry["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+            # Touched or copied: only re-render if the content really changed
+            fresh = entry["size"] == st.st_size and entry["sha256"] == file_digest(src)
+        if fresh:
+            entries[src.name] = dict(entry, size=st.st_size, mtime_ns=st.st_mtime_ns)
+        else:
+            entries[src.name] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                 "max_dim": max_dim, "quality": quality, "tile_size": tile_size,
+                                 "preview": dest.name}
+            jobs.append((str(src), str(dest), max_dim, quality, tile_size))
+
+    frames = _volume_frames(volume, srcs) if jobs else {}
+    if frames:
+        vol = open_volume(volume)
+        for src, dest, _, _, _ in [job for job in jobs if Path(job[0]).name in frames]:
+            idx, digest = frames[Path(src).name]
+            write_preview(Image.fromarray(np.asarray(vol[idx])), Path(src).stem, Path(dest),
+                          max_dim, quality, tile_size)
+            entries[Path(src).name]["sha256"] = digest
+        jobs = [job for job in jobs if Path(job[0]).name not in frames]
+    if jobs:
+        n_workers = min(len(jobs), workers or os.cpu_count() or 1)
+        if len(jobs) < MIN_PARALLEL_JOBS or n_workers <= 1:
+            digests = [_render_job(job) for job in jobs]
+        else:
+            pool = _render_pool(n_workers)
+            try:
+                digests = list(pool.map(_render_job, jobs, chunksize=max(1, len(jobs) // (4 * n_workers))))
+            except BrokenProcessPool:
+                _discard_render_pool(pool)
+                raise
+        for (src, *_), digest in zip(jobs, digests):
+            entries[Path(src).name]["sha256"] = digest
+
+    if entries != manifest:
+        write_manifest(prev_dir, entries)
+
+    preview_paths = [preview_path(src, prev_dir) for src in srcs]
+    preview_paths.sort(key=lambda p: p.name)
+    if sprite and preview_paths:
+        build_sprite(prev_dir, preview_paths, manifest=entries)
+    return preview_paths
+
+
+def cached_build_previews(cache: DiskCache, seg_dir: Path, prev_dir: Path, workers: Optional[int] = None,
+                          **kwargs) -> List[Path]:
+    """
+    build_previews behind a shared disk cache. Keyed on the source folder's
+    mtime and the preview parameters, and valid while the preview folder is
+    unchanged: a hit costs two stat calls and one mapped read, with no folder
+    scan and no manifest read. A slice overwritten in place keeps the folder's
+    mtime, so it is picked up once the folder changes or the entry is evicted.
+    `workers` only changes how stale previews are rendered, not the key.
+    """
+    seg_dir, prev_dir = Path(seg_dir), Path(prev_dir)
+    try:
+        seg_mtime = seg_dir.stat().st_mtime_ns
+    except FileNotFoundError:
+        return []
+    key = cache_key("previews", MANIFEST_VERSION, str(seg_dir), str(prev_dir), seg_mtime, kwargs)
+    hit = cache.get_json(key)
+    if hit is not None and prev_dir.exists() and hit["prev_mtime_ns"] == prev_dir.stat().st_mtime_ns:
+        return [prev_dir / name for name in hit["previews"]]
+
+    previews = build_previews(seg_dir, prev_dir, workers=workers, **kwargs)
+    cache.put_json(key, {"prev_mtime_ns": prev_dir.stat().st_mtime_ns, "previews": [p.name for p in previews]})
+    return previews
+
+
+# ===== SPRITE SHEET =====
+def read_sprite_meta(prev_dir: Path) -> Optional[dict]:
+    """Layout of the sprite sheet: thumb size, columns and the slice name of each cell."""
+    try:
+        with open(prev_dir / SPRITE_META_NAME, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_sprite(prev_dir: Path, preview_paths: List[Path], thumb_width: int = 160,
+                 columns: int = 8, quality: int = 70, manifest: Optional[Dict[str, dict]] = None) -> Path:
+    """
+    Pack small thumbnails of every preview, in slice order, into one WebP grid
+    (row-major, `columns` per row) so a case overview is a single request.
+    Rebuilt only when the set of previews or their content changed.
+    """
+    if manifest is None:
+        manifest = read_manifest(prev_dir)
+    by_preview = {e.get("preview"): e for e in manifest.values()}
+    key_src = [(p.name, by_preview.get(p.name, {}).get("sha256"), by_preview.get(p.name, {}).get("max_dim"))
+               for p in preview_paths]
+    key = hashlib.sha256(json.dumps([key_src, thumb_width, columns, quality]).encode()).hexdigest()
+
+    dest = prev_dir / SPRITE_NAME
+    meta = read_sprite_meta(prev_dir)
+    if meta is not None and meta.get("key") == key and dest.exists():
+        return dest
+
+    thumbs = []
+    for p in preview_paths:
+        with Image.open(p) as img:
+            img = img.convert("RGB")
+            h = max(1, round(img.height * thumb_width / img.width))
+            thumbs.append(img.resize((thumb_width, h), Image.Resampling.BILINEAR))
+    cell_h = max(t.height for t in thumbs)
+    rows = -(-len(thumbs) // columns)
+    sheet = Image.new("RGB", (thumb_width * min(columns, len(thumbs)), cell_h * rows))
+    for i, thumb in enumerate(thumbs):
+        sheet.paste(thumb, ((i % columns) * thumb_width, (i // columns) * cell_h))
+
+    tmp = temp_path(dest)
+    sheet.save(tmp, format="WEBP", quality=quality, method=0)
+    os.replace(tmp, dest)
+    meta = {"key": key, "thumb_width": thumb_width, "cell_height": cell_h, "columns": columns,
+            "names": [p.name for p in preview_paths]}
+    tmp = temp_path(prev_dir / SPRITE_META_NAME)
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, prev_dir / SPRITE_META_NAME)
+    return dest
@@ -0,0 +1,267 @@
+# oct_pipeline/registry.py
+# On-disk (SQLite) index of the cases found under images/.
+#
+# A case is a folder images/oct_segmentation<N>/ of B-scans, with its WebP
+# previews in images/oct_segmentation_previews<N>/ and its depth map in
+# images/heatmaps_npy/ (or the Plotly export in images/heatmaps_json/).
+# Case 1's heatmap is "3d_heatmap", case N's is "3d_heatmap<N>".
+#
+# refresh() is incremental: a case folder whose mtime has not changed is not
+# listed again, and only new or modified slices are re-read. Pages read the
+# index instead of sweeping the folders on every rerun.
+
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from . import heatmaps
+from .disk_cache import DiskCache, cache_key
+from .enface import enface_grid
+from .metrics import METRICS
+from .previews import ALLOWED_EXTS, preview_path
+from .volume import surface_volume
+
+ENFACE_ROWS = (200, 1000)     # scan positions of an interpolated surface: coarse / full resolution
+
+CASE_DIR_RE = re.compile(r"^oct_segmentation(\d+)$")
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    case_id      INTEGER PRIMARY KEY,
+    label        TEXT NOT NULL,
+    seg_dir      TEXT NOT NULL,
+    prev_dir     TEXT NOT NULL,
+    dir_mtime_ns INTEGER NOT NULL,
+    n_slices     INTEGER NOT NULL,
+    width        INTEGER,
+    height       INTEGER,
+    heatmap      TEXT,
+    heatmap_mtime_ns INTEGER,
+    volume_ul    REAL,
+    volume_scans INTEGER,
+    updated_at   REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slices (
+    case_id  INTEGER NOT NULL REFERENCES cases(case_id) ON DELETE CASCADE,
+    name     TEXT NOT NULL,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width    INTEGER NOT NULL,
+    height   INTEGER NOT NULL,
+    PRIMARY KEY (case_id, name)
+);
+"""
+
+
+@dataclass(frozen=True)
+class CaseRecord:
+    case_id: int
+    label: str
+    seg_dir: Path
+    prev_dir: Path
+    n_slices: int
+    width: Optional[int]          # most common slice size of the case
+    height: Optional[int]
+    heatmap: Optional[Path]       # .npy (binary depth map) or .json (Plotly export)
+    volume_ul: Optional[float]
+    volume_scans: Optional[int]   # number of B-scans in the depth map used for the volume
+
+
+@dataclass(frozen=True)
+class SliceRecord:
+    name: str
+    path: Path
+    preview: Path
+    width: int
+    height: int
+
+
+def heatmap_stem(case_id: int) -> str:
+    return "3d_heatmap" if case_id == 1 else f"3d_heatmap{case_id}"
+
+
+class CaseRegistry:
+    """SQLite-backed case index rooted at an images/ directory."""
+
+    def __init__(self, images_dir: Path, db_path: Optional[Path] = None):
+        self.images_dir = Path(images_dir)
+        self.db_path = Path(db_path) if db_path else self.images_dir / "cases.sqlite"
+        with closing(self._connect()) as con, con:
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                con.executescript("DROP TABLE IF EXISTS slices; DROP TABLE IF EXISTS cases;")
+                con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            con.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # One short-lived connection per call: safe from Streamlit's script threads
+        con = sqlite3.connect(self.db_path, timeout=30)
+        con.execute("PRAGMA foreign_keys = ON")
+        return con
+
+    # ===== INDEXING =====
+    def refresh(self) -> List[int]:
+        """Re-index new or changed case folders; returns the case ids that were (re)scanned."""
+        found: Dict[int, Path] = {}
+        if self.images_dir.exists():
+            for entry in os.scandir(self.images_dir):
+                m = CASE_DIR_RE.match(entry.name)
+                if m and entry.is_dir():
+                    found[int(m.group(1))] = Path(entry.path)
+
+        rescanned = []
+        with closing(self._connect()) as con, con:
+            known = {row[0]: row[1:] for row in con.execute(
+                "SELECT case_id, dir_mtime_ns, heatmap, heatmap_mtime_ns FROM cases")}
+            for case_id in set(known) - set(found):
+                con.execute("DELETE FROM cases WHERE case_id = ?", (case_id,))
+
+            for case_id, seg_dir in sorted(found.items()):
+                dir_mtime = seg_dir.stat().st_mtime_ns
+                heatmap, heatmap_mtime = self._locate_heatmap(case_id)
+                prev = known.get(case_id)
+                if prev is None or prev[0] != dir_mtime:
+                    self._index_slices(con, case_id, seg_dir, dir_mtime)
+                    rescanned.append(case_id)
+                if prev is None or prev[0] != dir_mtime or prev[1:] != (heatmap, heatmap_mtime):
+                    self._index_heatmap(con, case_id, heatmap, heatmap_mtime)
+        return rescanned
+
+    def _locate_heatmap(self, case_id: int) -> Tuple[Optional[str], Optional[int]]:
+        stem = heatmap_stem(case_id)
+        npy_path, meta_path = heatmaps.heatmap_paths(self.images_dir / "heatmaps_npy" / stem)
+        if npy_path.exists() and meta_path.exists():
+            return str(npy_path), max(npy_path.stat().st_mtime_ns, meta_path.stat().st_mtime_ns)
+        json_path = self.images_dir / "heatmaps_json" / (stem + ".json")
+        if json_path.exists():
+            return str(json_path), json_path.stat().st_mtime_ns
+        return None, None
+
+    def _index_slices(self, con: sqlite3.Connection, case_id: int, seg_dir: Path, dir_mtime: int) -> None:
+        old = {row[0]: row[1:] for row in con.execute(
+            "SELECT name, size, mtime_ns, width, height FROM slices WHERE case_id = ?", (case_id,))}
+        rows = []
+        for entry in os.scandir(seg_dir):
+            if not entry.is_file() or os.path.splitext(entry.name)[1].lower() not in ALLOWED_EXTS:
+                continue
+            st = entry.stat()
+            cached = old.get(entry.name)
+            if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+                width, height = cached[2:]
+            else:
+                with Image.open(entry.path) as img:   # header only, no pixel decode
+                    width, height = img.size
+            rows.append((case_id, entry.name, st.st_size, st.st_mtime_ns, width, height))
+
+        sizes = [(r[4], r[5]) for r in rows]
+        width, height = max(set(sizes), key=sizes.count) if sizes else (None, None)
+        con.execute(
+            "INSERT INTO cases (case_id, label, seg_dir, prev_dir, dir_mtime_ns, n_slices, width, height, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(case_id) DO UPDATE SET seg_dir = excluded.seg_dir, prev_dir = excluded.prev_dir, "
+            "dir_mtime_ns = excluded.dir_mtime_ns, n_slices = excluded.n_slices, width = excluded.width, "
+            "height = excluded.height, updated_at = excluded.updated_at",
+            (case_id, f"Corneal Ulcer {case_id}", str(seg_dir),
+             str(self.images_dir / f"oct_segmentation_previews{case_id}"),
+             dir_mtime, len(rows), width, height, time.time()),
+        )
+        con.execute("DELETE FROM slices WHERE case_id = ?", (case_id,))
+        con.executemany("INSERT INTO slices VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def _index_heatmap(self, con: sqlite3.Connection, case_id: int, heatmap: Optional[str],
+                       heatmap_mtime: Optional[int]) -> None:
+        volume_ul = volume_scans = None
+        if heatmap:
+            hm = load_depth_map(Path(heatmap))
+            vol = surface_volume(hm.x, hm.y, hm.z, **hm.axis_units_um())
+            volume_ul, volume_scans = vol.volume_ul, vol.n_slices
+        con.execute(
+            "UPDATE cases SET heatmap = ?, heatmap_mtime_ns = ?, volume_ul = ?, volume_scans = ?, updated_at = ? "
+            "WHERE case_id = ?",
+            (heatmap, heatmap_mtime, volume_ul, volume_scans, time.time(), case_id),
+        )
+
+    # ===== QUERIES =====
+    def cases(self) -> List[CaseRecord]:
+        with closing(self._connect()) as con:
+            rows = con.execute(
+                "SELECT case_id, label, seg_dir, prev_dir, n_slices, width, height, heatmap, volume_ul, volume_scans "
+                "FROM cases ORDER BY case_id").fetchall()
+        return [CaseRecord(case_id=r[0], label=r[1], seg_dir=Path(r[2]), prev_dir=Path(r[3]), n_slices=r[4],
+                           width=r[5], height=r[6], heatmap=Path(r[7]) if r[7] else None,
+                           volume_ul=r[8], volume_scans=r[9]) for r in rows]
+
+    def case(self, case_id: int) -> Optional[CaseRecord]:
+        return next((c for c in self.cases() if c.case_id == case_id), None)
+
+    def slices(self, case_id: int) -> List[SliceRecord]:
+        with closing(self._connect()) as con:
+            row = con.execute("SELECT seg_dir, prev_dir FROM cases WHERE case_id = ?", (case_id,)).fetchone()
+            if row is None:
+                return []
+            names = con.execute("SELECT name, width, height FROM slices WHERE case_id = ? ORDER BY name",
+                                (case_id,)).fetchall()
+        seg_dir, prev_dir = Path(row[0]), Path(row[1])
+        return [SliceRecord(name=n, path=seg_dir / n, preview=preview_path(seg_dir / n, prev_dir),
+                            width=w, height=h) for n, w, h in names]
+
+
+def load_depth_map(path: Path) -> heatmaps.Heatmap:
+    """Depth map from a binary .npy heatmap (memory-mapped) or a Plotly .json export."""
+    path = Path(path)
+    if path.suffix == ".json":
+        return heatmaps.heatmap_from_plotly_json(path)
+    return heatmaps.load_heatmap(path)
+
+
+def cached_depth_map(path: Path, cache: DiskCache, lod: bool = True) -> heatmaps.Heatmap:
+    """
+    load_depth_map (reduced with coarse_lod unless `lod=False`) through a shared
+    disk cache keyed on the source files' size / mtime. A hit parses nothing:
+    the grids are zero-copy views of the memory-mapped cache entry.
+    """
+    path = Path(path)
+    sources = (path,) if path.suffix == ".json" else heatmaps.heatmap_paths(path)
+    stats = [(str(p), st.st_size, st.st_mtime_ns) for p, st in ((p, p.stat()) for p in sources)]
+    key = cache_key("depth_map", heatmaps.FORMAT_VERSION, stats, lod)
+    hit = cache.get_arrays(key)
+    if hit is not None:
+        arrays, meta = hit
+        return heatmaps.Heatmap(z=arrays["z"], x=arrays["x"], y=arrays["y"], **meta)
+
+    hm = load_depth_map(path)
+    if lod:
+        hm = heatmaps.coarse_lod(hm)
+    cache.put_arrays(key, {"z": np.asarray(hm.z), "x": np.asarray(hm.x), "y": np.asarray(hm.y)},
+                     {"colorscale": hm.colorscale, "hovertemplate": hm.hovertemplate,
+                      "layout": hm.layout, "units_um": hm.units_um})
+    return hm
+
+
+def load_figure(path: Path, cache: Optional[DiskCache] = None, full_res: bool = False,
+                interp: Optional[str] = None):
+    """
+    3D topography figure of a depth map; a coarse level of detail unless
+    `full_res` is set. With `cache`, the depth map comes from cached_depth_map;
+    without, it is parsed from `path`. With `interp`, the surface is
+    interpolated between B-scans (see enface).
+    """
+    if cache is not None:
+        hm = cached_depth_map(path, cache, lod=not full_res)
+    else:
+        hm = load_depth_map(path)
+        if not full_res:
+            hm = heatmaps.coarse_lod(hm)
+    if interp is not None:
+        with METRICS.timer("stage_seconds", stage="enface_grid"):
+            hm = enface_grid(hm, n_y=ENFACE_ROWS[full_res], n_x=None, method=interp)
+    return heatmaps.heatmap_figure(hm)
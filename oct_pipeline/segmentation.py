@@ -0,0 +1,252 @@
+# oct_pipeline/segmentation.py
+# Sobel-Y + weighted moving average contour engine, batched over whole acquisitions.
+#
+# Every stage works on a (n_slices, H, W) stack at once: the gradient is two
+# separable 1D correlations over the whole volume, the contour pick is one
+# cumulative sum and one argmax over the row axis and the smoothing is one
+# correlation over the column axis. There is no per-slice Python loop anywhere
+# in the hot path.
+
+from dataclasses import dataclass
+from math import comb
+from pathlib import Path
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+from scipy import ndimage
+
+
+# ===== PARAMETERS =====
+@dataclass(frozen=True)
+class SegmentationParams:
+    ksize: int = 3                # Sobel kernel size (odd, >= 3)
+    threshold: float = 0.1        # minimum positive gradient kept (intensities scaled to [0, 1])
+    border: int = 6               # px ignored along the image frame (exports carry a 4-5 px white border)
+    edge_run: int = 8             # rows below an edge over which the brightness step is measured
+    edge_fraction: float = 0.5    # an edge's step must reach this fraction of the column's strongest
+    smooth_window: int = 15       # weighted moving average window, in columns (odd)
+    ref_degree: int = 4           # polynomial degree of the healthy (reference) surface
+    ref_iterations: int = 4       # reweighting passes used to ignore the lesion when fitting
+    ref_tolerance: float = 2.0    # px below the reference still treated as healthy surface
+    min_depth: float = 1.0        # depths below this (px) are treated as noise
+
+
+@dataclass
+class SegmentationResult:
+    contours: np.ndarray     # (n, W) raw anterior contour row per column, NaN where no edge
+    smoothed: np.ndarray     # (n, W) contour after the weighted moving average
+    reference: np.ndarray    # (n, W) fitted healthy anterior surface
+    depth: np.ndarray        # (n, W) lesion depth in px (smoothed contour below reference), >= 0
+
+
+# ===== LOADING =====
+def read_stack(paths: Sequence[Path]) -> np.ndarray:
+    """
+    Decode B-scans into a single (n_slices, H, W) uint8 grayscale stack.
+    All slices of an acquisition must share the same size.
+    """
+    if not paths:
+        raise ValueError("read_stack needs at least one slice")
+    first = _read_gray(paths[0])
+    stack = np.empty((len(paths),) + first.shape, dtype=np.uint8)
+    stack[0] = first
+    for i, p in enumerate(paths[1:], start=1):
+        frame = _read_gray(p)
+        if frame.shape != first.shape:
+            raise ValueError(f"{p.name} is {frame.shape[::-1]}, expected {first.shape[::-1]}")
+        stack[i] = frame
+    return stack
+
+
+def _read_gray(path: Path) -> np.ndarray:
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        return np.asarray(img.convert("L"))
+
+
+# ===== GRADIENT =====
+def sobel_kernels(ksize: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the (derivative, smoothing) 1D kernels of a separable Sobel operator,
+    matching OpenCV's coefficients (ksize=3 -> [-1, 0, 1] and [1, 2, 1]).
+    """
+    if ksize < 3 or ksize % 2 == 0:
+        raise ValueError(f"ksize must be an odd integer >= 3, got {ksize}")
+    smooth = np.array([comb(ksize - 1, k) for k in range(ksize)], dtype=np.float32)
+    base = np.array([comb(ksize - 3, k) for k in range(ksize - 2)], dtype=np.float32)
+    deriv = np.convolve(base, [-1.0, 0.0, 1.0]).astype(np.float32)
+    return deriv, smooth
+
+
+def sobel_y(stack: np.ndarray, ksize: int = 3) -> np.ndarray:
+    """
+    Vertical Sobel gradient of a (n, H, W) stack, intensities scaled to [0, 1].
+    Positive values are dark -> bright transitions going down a column.
+    """
+    deriv, smooth = sobel_kernels(ksize)
+    # Normalise so the response of a unit step is 1 whatever the kernel size
+    smooth /= smooth.sum()
+    deriv /= np.abs(deriv).sum() / 2
+    vol = np.asarray(stack, dtype=np.float32) / 255.0
+    grad = ndimage.correlate1d(vol, deriv, axis=-2, mode="nearest")
+    return ndimage.correlate1d(grad, smooth, axis=-1, mode="nearest")
+
+
+def positive_gradient(grad: np.ndarray, threshold: float = 0.1) -> np.ndarray:
+    """Keep only positive gradients above `threshold` (upper corneal surface); zero the rest."""
+    return np.where(grad > threshold, grad, 0.0).astype(np.float32, copy=False)
+
+
+def edge_step(grad: np.ndarray, run: int = 8) -> np.ndarray:
+    """
+    Signed vertical gradient summed over `run` rows, from each row down: how
+    much brighter a column stays below a row than above it. A speckle or a
+    drawn line is bright for a row or two, so its step cancels out; the top of
+    the cornea stays bright and keeps a large step.
+    """
+    n = grad.shape[-2]
+    cum = np.empty(grad.shape[:-2] + (n + 1, grad.shape[-1]), dtype=np.float32)
+    cum[..., 0, :] = 0
+    # Running sum one row at a time: np.cumsum along a non-last axis is ~2.5x slower
+    for r in range(n):
+        np.add(cum[..., r, :], grad[..., r, :], out=cum[..., r + 1, :])
+    step = np.empty(cum.shape[:-2] + (n, cum.shape[-1]), dtype=np.float32)
+    m = min(max(n - run + 1, 0), n)   # rows whose run fits in the column
+    np.subtract(cum[..., run:run + m, :], cum[..., :m, :], out=step[..., :m, :])
+    np.subtract(cum[..., n:, :], cum[..., m:n, :], out=step[..., m:, :])
+    return step
+
+
+# ===== CONTOUR =====
+def pick_anterior_contour(grad_pos: np.ndarray, step: Optional[np.ndarray] = None,
+                          fraction: float = 0.5) -> np.ndarray:
+    """
+    Per-column anterior contour: the first row, from the top, with a retained
+    positive gradient (`grad_pos` may also be a boolean mask of those rows).
+    With `step` (see edge_step), that row's step must also be positive and
+    reach `fraction` of the largest step among the column's retained rows, so
+    isolated bright pixels above the cornea are skipped. Returns float rows,
+    NaN where a column has no edge.
+    """
+    hits = grad_pos > 0
+    if step is not None:
+        strongest = step.max(axis=-2, initial=0.0, where=hits, keepdims=True)
+        hits &= step >= np.maximum(fraction * strongest, np.finfo(np.float32).tiny)
+    rows = np.argmax(hits, axis=-2).astype(np.float32)
+    rows[~hits.any(axis=-2)] = np.nan
+    return rows
+
+
+def weighted_moving_average(profiles: np.ndarray, window: int = 15) -> np.ndarray:
+    """
+    Triangular-weighted moving average along the last axis, ignoring NaNs.
+    Columns that had no contour pick stay NaN (gaps are not filled in).
+    """
+    if window < 1 or window % 2 == 0:
+        raise ValueError(f"window must be a positive odd integer, got {window}")
+    if window == 1:
+        return np.array(profiles, dtype=np.float32)
+    half = window // 2 + 1
+    weights = np.concatenate([np.arange(1, half + 1), np.arange(half - 1, 0, -1)]).astype(np.float32)
+    valid = np.isfinite(profiles).astype(np.float32)
+    values = np.where(valid > 0, profiles, 0.0).astype(np.float32)
+    num = ndimage.correlate1d(values, weights, axis=-1, mode="constant")
+    den = ndimage.correlate1d(valid, weights, axis=-1, mode="constant")
+    out = np.full_like(num, np.nan)
+    np.divide(num, den, out=out, where=(den > 0) & (valid > 0))
+    return out
+
+
+def fit_reference_surface(contours: np.ndarray, degree: int = 4, iterations: int = 4,
+                          tolerance: float = 2.0) -> np.ndarray:
+    """
+    Fit the healthy anterior surface of every slice with one batched least-squares
+    solve per pass. Points sitting deeper than `tolerance` px below the current
+    fit (the ulcer) are dropped before the next pass.
+    """
+    n, w = contours.shape
+    t = np.linspace(-1.0, 1.0, w)
+    vander = np.vander(t, degree + 1)                       # (W, d)
+    weights = np.isfinite(contours).astype(np.float64)      # (n, W)
+    y = np.where(weights > 0, contours, 0.0).astype(np.float64)
+    ridge = 1e-9 * np.eye(degree + 1)
+
+    fit = np.zeros((n, w))
+    for _ in range(max(iterations, 1)):
+        gram = np.einsum("nw,wi,wj->nij", weights, vander, vander) + ridge
+        rhs = np.einsum("nw,wi,nw->ni", weights, vander, y)
+        coef = np.linalg.solve(gram, rhs[..., None])[..., 0]
+        fit = coef @ vander.T
+        keep = np.isfinite(contours) & (contours - fit <= tolerance)
+        # Never let a slice lose every support point
+        keep |= ~keep.any(axis=1, keepdims=True) & np.isfinite(contours)
+        weights = keep.astype(np.float64)
+    return fit.astype(np.float32)
+
+
+# ===== PIPELINE =====
+def segment_stack(stack: np.ndarray, params: SegmentationParams = SegmentationParams()) -> SegmentationResult:
+    """
+    Segment a whole acquisition: Sobel-Y, keep positive gradients, pick the
+    anterior contour per column (the first edge that stays bright), smooth it
+    with a weighted moving average and measure the lesion depth against the
+    fitted healthy surface.
+    """
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[None]
+    if stack.ndim != 3:
+        raise ValueError(f"expected a (n_slices, H, W) stack, got shape {stack.shape}")
+
+    return segment_gradient(sobel_y(stack, params.ksize), params)
+
+
+def segment_gradient(grad: np.ndarray, params: SegmentationParams = SegmentationParams()) -> SegmentationResult:
+    """
+    Stages of `segment_stack` after the Sobel filter. `grad` is left untouched,
+    so a cached gradient can be re-segmented with another threshold or window.
+    """
+    grad = np.asarray(grad[None] if grad.ndim == 2 else grad, dtype=np.float32)
+    # Rows inside the border as a view: the same picks as zeroing the border rows, without a copy
+    b = max(params.border, 0)
+    inner = grad[:, b:grad.shape[1] - b]
+    step = edge_step(inner, params.edge_run)
+    hits = inner > max(params.threshold, 0.0)   # rows positive_gradient would keep
+    if b:
+        hits[:, :, :b] = False
+        hits[:, :, -b:] = False
+    contours = pick_anterior_contour(hits, step, params.edge_fraction) + b
+    del hits, step
+    return segment_contours(contours, params)
+
+
+def segment_contours(contours: np.ndarray, params: SegmentationParams = SegmentationParams()) -> SegmentationResult:
+    """Downstream stages of `segment_stack`, starting from raw contour picks."""
+    smoothed = weighted_moving_average(contours, params.smooth_window)
+    reference = fit_reference_surface(smoothed, params.ref_degree, params.ref_iterations, params.ref_tolerance)
+    depth = np.nan_to_num(smoothed - reference, nan=0.0)
+    depth[depth < params.min_depth] = 0.0
+    return SegmentationResult(contours=contours, smoothed=smoothed, reference=reference, depth=depth)
+
+
+# ===== OVERLAY =====
+def overlay_contours(gray: np.ndarray, smoothed: np.ndarray, reference: np.ndarray,
+                     thickness: int = 1) -> np.ndarray:
+    """
+    (H, W, 3) uint8 rendering of one B-scan with its smoothed anterior contour
+    (red), fitted healthy surface (green) and the lesion between them tinted.
+    """
+    gray = np.asarray(gray, dtype=np.uint8)
+    h, w = gray.shape
+    rgb = np.repeat(gray[..., None], 3, axis=-1)
+    rows = np.arange(h)[:, None]
+    lesion = (rows > reference[None, :]) & (rows < smoothed[None, :])   # NaN compares False
+    rgb[lesion] = (rgb[lesion] * 0.5 + np.array([0, 0, 127])).astype(np.uint8)
+    cols = np.arange(w)
+    for line, colour in ((reference, (0, 255, 0)), (smoothed, (255, 0, 0))):
+        ok = np.isfinite(line)
+        for dy in range(-(thickness // 2), thickness // 2 + 1):
+            r = np.clip(np.round(line[ok]).astype(int) + dy, 0, h - 1)
+            rgb[r, cols[ok]] = colour
+    return rgb
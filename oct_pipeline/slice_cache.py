@@ -0,0 +1,221 @@
+# oct_pipeline/slice_cache.py
+# Incremental re-segmentation: per-slice results cached by content hash.
+#
+# Every segmentation stage works slice by slice, so a slice's result depends
+# only on its pixels and the SegmentationParams. Results are stored
+# content-addressed under <cache_dir>/results/<params key>/<sha256>.npy, as a
+# (4, W) float32 array (contour, smoothed, reference, depth; see SegmentationResult).
+#
+# update_case() keeps, per case, a state file and the (n_slices, W) depth map:
+#   <state_dir>/state.json   slice names, size / mtime, sha256, area; geometry; volume
+#   <state_dir>/depth.npy    depth map in px, patched row by row
+# When a technician replaces one B-scan, only that slice is hashed and
+# segmented again, its depth-map row is rewritten in place and the volume is
+# patched with the slice's trapezoid weight instead of re-integrating the case.
+# Given the case's packed volume (volume_store), slices it holds unchanged take
+# their sha256 from its provenance and their pixels from the memory map, so
+# nothing is decoded or hashed twice.
+
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .disk_cache import temp_path
+from .previews import file_digest
+from .segmentation import SegmentationParams, SegmentationResult, read_stack, segment_stack
+from .volume import VolumeAccumulator, VolumeResult, scan_spacing_um
+from .volume_store import open_volume, packed_frames
+
+STATE_VERSION = 1
+STATE_NAME = "state.json"
+DEPTH_NAME = "depth.npy"
+
+
+def params_key(params: SegmentationParams) -> str:
+    return hashlib.sha256(json.dumps(asdict(params), sort_keys=True).encode()).hexdigest()[:16]
+
+
+class SliceCache:
+    """Content-addressed per-slice segmentation results for one parameter set."""
+
+    def __init__(self, cache_dir: Path, params: SegmentationParams = SegmentationParams()):
+        self.params = params
+        self.root = Path(cache_dir) / "results" / params_key(params)
+
+    def path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / (sha256 + ".npy")
+
+    def get(self, sha256: str) -> Optional[np.ndarray]:
+        try:
+            return np.load(self.path(sha256))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, sha256: str, rows: np.ndarray) -> None:
+        dest = self.path(sha256)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        # Unique name: cases sharing a cache_dir may store the same slice concurrently
+        tmp = temp_path(dest).with_suffix(".npy")
+        np.save(tmp, np.asarray(rows, dtype=np.float32))
+        os.replace(tmp, dest)
+
+    def segment(self, paths: Sequence[Path], digests: Sequence[str], chunk_size: int = 8,
+                volume: Optional[Path] = None) -> Dict[str, np.ndarray]:
+        """
+        {sha256: (4, W) result} for `paths`, segmenting (and storing) only the
+        ones not cached yet. Slices held unchanged by `volume` (a pack, see
+        volume_store) are read from its memory map instead of decoded.
+        """
+        out: Dict[str, np.ndarray] = {}
+        missing = []
+        for p, sha in zip(paths, digests):
+            if sha in out:
+                continue
+            rows = self.get(sha)
+            if rows is None:
+                missing.append((p, sha))
+            else:
+                out[sha] = rows
+        packed = packed_frames(volume, [p for p, _ in missing]) if volume is not None and missing else {}
+        vol = open_volume(volume) if packed else None
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            if all(Path(p).name in packed for p, _ in chunk):
+                stack = vol[[packed[Path(p).name][0] for p, _ in chunk]]
+            else:
+                stack = read_stack([p for p, _ in chunk])
+            res = segment_stack(stack, self.params)
+            for i, (_, sha) in enumerate(chunk):
+                rows = np.stack([res.contours[i], res.smoothed[i], res.reference[i], res.depth[i]])
+                self.put(sha, rows)
+                out[sha] = rows.astype(np.float32)
+        return out
+
+
+@dataclass
+class CaseUpdate:
+    depth: np.ndarray              # (n_slices, W) depth map in px (read-only memory map)
+    volume: VolumeResult
+    resegmented: List[str]         # slices that had to be segmented (cache misses)
+    patched_rows: List[int]        # depth-map rows rewritten in place (empty on a full rebuild)
+    rebuilt: bool                  # True when the depth map was assembled from scratch
+
+
+def read_state(state_dir: Path) -> Optional[dict]:
+    try:
+        with open(Path(state_dir) / STATE_NAME, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if state.get("version") == STATE_VERSION else None
+
+
+def _write_state(state_dir: Path, state: dict) -> None:
+    tmp = temp_path(Path(state_dir) / STATE_NAME)
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, Path(state_dir) / STATE_NAME)
+
+
+def update_case(paths: Sequence[Path], state_dir: Path, scan_length_um: float, pixel_width_um: float,
+                pixel_depth_um: float, params: SegmentationParams = SegmentationParams(),
+                cache_dir: Optional[Path] = None, volume: Optional[Path] = None) -> CaseUpdate:
+    """
+    Bring a case's depth map and volume up to date with its B-scans (`paths`,
+    in slice order, one size). Unchanged slices (same size / mtime, or same
+    content) cost a stat call; changed ones are segmented and patched in.
+    `cache_dir` defaults to `state_dir`; share it between cases to reuse
+    results of identical slices. With `volume`, the case's pack (see
+    volume_store), slices it holds are neither hashed nor decoded again.
+    """
+    paths = [Path(p) for p in paths]
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    cache = SliceCache(cache_dir or state_dir, params)
+    geometry = {"scan_spacing_um": scan_spacing_um(scan_length_um, len(paths)),
+                "pixel_width_um": pixel_width_um, "pixel_depth_um": pixel_depth_um}
+
+    state = read_state(state_dir)
+    depth_path = state_dir / DEPTH_NAME
+    if state is not None and (state.get("params") != params_key(params) or state.get("geometry") != geometry
+                              or not depth_path.exists()):
+        state = None
+    known = {s["name"]: s for s in state["slices"]} if state else {}
+    packed = packed_frames(volume, paths) if volume is not None else {}
+
+    slices = []
+    for p in paths:
+        st = p.stat()
+        old = known.get(p.name)
+        if old is not None and (old["size"], old["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+            sha = old["sha256"]
+        elif p.name in packed:
+            sha = packed[p.name][1]   # hashed when packed, same size / mtime since
+        else:
+            sha = file_digest(p)   # new, touched or replaced: the content decides
+        slices.append({"name": p.name, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha})
+
+    same_layout = state is not None and [s["name"] for s in state["slices"]] == [s["name"] for s in slices]
+    changed = [i for i, s in enumerate(slices)
+               if not same_layout or state["slices"][i]["sha256"] != s["sha256"]]
+    uncached = {slices[i]["sha256"] for i in changed if not cache.path(slices[i]["sha256"]).exists()}
+    results = cache.segment([paths[i] for i in changed], [slices[i]["sha256"] for i in changed], volume=volume)
+    resegmented = [slices[i]["name"] for i in changed if slices[i]["sha256"] in uncached]
+
+    width = next(iter(results.values())).shape[1] if results else None
+    if same_layout and (width is None or np.load(depth_path, mmap_mode="r").shape[1] == width):
+        depth = np.load(depth_path, mmap_mode="r+")
+        acc = VolumeAccumulator.from_areas([s["area_mm2"] for s in state["slices"]], **geometry)
+        for i in changed:
+            profile = results[slices[i]["sha256"]][3]
+            depth[i] = profile
+            acc.replace(i, profile)
+        depth.flush()
+        del depth
+        patched, rebuilt = changed, False
+    else:
+        if width is None:
+            raise ValueError("update_case needs at least one slice")
+        # Unique names: two runs may update the same case at once; the last rename wins whole
+        tmp = temp_path(depth_path).with_suffix(".npy")
+        depth = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(len(slices), width))
+        acc = VolumeAccumulator(**geometry)
+        for i, s in enumerate(slices):
+            depth[i] = results[s["sha256"]][3]
+            acc.add(depth[i])
+        depth.flush()
+        del depth
+        os.replace(tmp, depth_path)
+        patched, rebuilt = [], True
+
+    for s, area in zip(slices, acc.areas_mm2):
+        s["area_mm2"] = area
+    _write_state(state_dir, {"version": STATE_VERSION, "params": params_key(params), "geometry": geometry,
+                             "slices": slices, "volume_ul": acc.volume_ul})
+    return CaseUpdate(depth=np.load(depth_path, mmap_mode="r"), volume=acc.result(), resegmented=resegmented,
+                      patched_rows=patched, rebuilt=rebuilt)
+
+
+def case_results(state_dir: Path, params: SegmentationParams = SegmentationParams(),
+                 cache_dir: Optional[Path] = None) -> SegmentationResult:
+    """
+    Full (n_slices, W) segmentation of a case as of its last update_case(),
+    assembled from the cached per-slice results (nothing is segmented again).
+    """
+    state = read_state(state_dir)
+    if state is None or state.get("params") != params_key(params):
+        raise ValueError(f"{state_dir}: no up-to-date case state for these parameters")
+    cache = SliceCache(cache_dir or state_dir, params)
+    rows = []
+    for s in state["slices"]:
+        result = cache.get(s["sha256"])
+        if result is None:
+            raise ValueError(f"{state_dir}: cached result of {s['name']} is missing")
+        rows.append(result)
+    stack = np.stack(rows, axis=1)   # (4, n, W)
+    return SegmentationResult(contours=stack[0], smoothed=stack[1], reference=stack[2], depth=stack[3])
@@ -0,0 +1,113 @@
+# oct_pipeline/tiles.py
+# Multi-resolution tile pyramids for inspecting B-scans at native resolution.
+#
+# Layout, per slice (<tiles_dir>/<slice stem>/):
+#   pyramid.json             width, height, tile_size and the size of every level
+#   <level>/<col>_<row>.webp tile_size x tile_size tiles (smaller on the right/bottom edge)
+# Level 0 is the native resolution; each next level halves both dimensions,
+# down to the first level that fits in a single tile.
+#
+# A zoomed view only opens the tiles that intersect the viewport, so looking at
+# one region of one slice costs a few kilobytes instead of a full TIFF decode.
+
+import json
+import os
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Tuple
+
+from PIL import Image
+
+from .disk_cache import temp_path
+
+PYRAMID_META = "pyramid.json"
+
+
+@dataclass(frozen=True)
+class Pyramid:
+    root: Path
+    width: int
+    height: int
+    tile_size: int
+    levels: List[Tuple[int, int]]     # (width, height) of each level, level 0 = native
+
+    def tile_path(self, level: int, col: int, row: int) -> Path:
+        return self.root / str(level) / f"{col}_{row}.webp"
+
+
+def pyramid_dir(src: Path, tiles_dir: Path) -> Path:
+    return tiles_dir / Path(src).stem
+
+
+def build_pyramid(img: Image.Image, out_dir: Path, tile_size: int = 256, quality: int = 80) -> Pyramid:
+    """Cut an (already decoded) slice into a tile pyramid under `out_dir`."""
+    # Drop tiles of a previous build (another tile size leaves a different grid)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    img = img.convert("RGB")
+    levels: List[Tuple[int, int]] = []
+    level_img = img
+    level = 0
+    while True:
+        levels.append(level_img.size)
+        level_root = out_dir / str(level)
+        level_root.mkdir(parents=True, exist_ok=True)
+        w, h = level_img.size
+        for row in range(-(-h // tile_size)):
+            for col in range(-(-w // tile_size)):
+                box = (col * tile_size, row * tile_size,
+                       min((col + 1) * tile_size, w), min((row + 1) * tile_size, h))
+                level_img.crop(box).save(level_root / f"{col}_{row}.webp", format="WEBP",
+                                         quality=quality, method=0)
+        if w <= tile_size and h <= tile_size:
+            break
+        level_img = level_img.resize((max(1, -(-w // 2)), max(1, -(-h // 2))), Image.Resampling.LANCZOS)
+        level += 1
+
+    meta = {"width": img.width, "height": img.height, "tile_size": tile_size, "levels": levels}
+    tmp = temp_path(out_dir / PYRAMID_META)
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, out_dir / PYRAMID_META)
+    return Pyramid(root=out_dir, width=img.width, height=img.height, tile_size=tile_size,
+                   levels=[tuple(lv) for lv in levels])
+
+
+def load_pyramid(root: Path) -> Pyramid:
+    with open(Path(root) / PYRAMID_META, "r") as f:
+        meta = json.load(f)
+    return Pyramid(root=Path(root), width=meta["width"], height=meta["height"],
+                   tile_size=meta["tile_size"], levels=[tuple(lv) for lv in meta["levels"]])
+
+
+def visible_tiles(pyr: Pyramid, level: int, box: Tuple[int, int, int, int]) -> List[Tuple[int, int]]:
+    """(col, row) of every tile at `level` intersecting `box` = (left, top, right, bottom) in level px."""
+    t = pyr.tile_size
+    left, top, right, bottom = box
+    return [(c, r)
+            for r in range(max(top, 0) // t, (min(bottom, pyr.levels[level][1]) - 1) // t + 1)
+            for c in range(max(left, 0) // t, (min(right, pyr.levels[level][0]) - 1) // t + 1)]
+
+
+def viewport(pyr: Pyramid, level: int, center: Tuple[float, float],
+             size: Tuple[int, int]) -> Tuple[Image.Image, Tuple[int, int, int, int], int]:
+    """
+    Crop of `size` (w, h) level pixels around `center` (fractions of the slice
+    width / height), stitched from the visible tiles only.
+    Returns (image, box in level px, number of tiles read).
+    """
+    lw, lh = pyr.levels[level]
+    w, h = min(size[0], lw), min(size[1], lh)
+    left = int(round(center[0] * lw - w / 2))
+    top = int(round(center[1] * lh - h / 2))
+    left = min(max(left, 0), lw - w)
+    top = min(max(top, 0), lh - h)
+    box = (left, top, left + w, top + h)
+
+    out = Image.new("RGB", (w, h))
+    tiles = visible_tiles(pyr, level, box)
+    t = pyr.tile_size
+    for col, row in tiles:
+        with Image.open(pyr.tile_path(level, col, row)) as tile:
+            out.paste(tile.convert("RGB"), (col * t - left, row * t - top))
+    return out, box, len(tiles)
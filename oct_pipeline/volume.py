@@ -0,0 +1,162 @@
+# oct_pipeline/volume.py
+# Lesion area per B-scan and total lesion volume, accumulated slice by slice.
+#
+# Areas are integrated along each depth profile (trapezoid rule over columns),
+# and the volume between two neighbouring B-scans is the mean of their areas
+# times the scan spacing. Only the previous slice's area is kept, so a case can
+# be streamed through without ever holding every decoded slice in memory.
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, List, Sequence, Union
+
+import numpy as np
+
+from .segmentation import SegmentationParams, read_stack, segment_stack
+
+UM2_PER_MM2 = 1e6
+
+# np.trapz was renamed in NumPy 2.0
+_trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+@dataclass
+class VolumeResult:
+    areas_mm2: List[float]   # lesion cross-section area of every slice
+    volume_ul: float         # total lesion volume
+    n_slices: int
+    scan_spacing_um: float
+
+
+def scan_spacing_um(scan_length_um: float, n_slices: int) -> float:
+    """
+    Distance between neighbouring B-scans when `n_slices` scans (11, 21, 41, 81…)
+    are spread evenly over a `scan_length_um` raster.
+    """
+    if n_slices < 2:
+        raise ValueError(f"need at least 2 slices to derive a spacing, got {n_slices}")
+    return scan_length_um / (n_slices - 1)
+
+
+def slice_area_mm2(depth_profile: np.ndarray, pixel_width_um: float, pixel_depth_um: float) -> float:
+    """Lesion area of one B-scan from its per-column depth profile (in px)."""
+    depth = np.nan_to_num(np.asarray(depth_profile, dtype=np.float64), nan=0.0)
+    if depth.size < 2:
+        return 0.0
+    area_px = float(_trapezoid(depth))
+    return area_px * pixel_width_um * pixel_depth_um / UM2_PER_MM2
+
+
+class VolumeAccumulator:
+    """
+    Streaming volume integration: feed depth profiles in slice order with
+    `add()`, read `volume_ul` at any point.
+    """
+
+    def __init__(self, scan_spacing_um: float, pixel_width_um: float, pixel_depth_um: float):
+        self.scan_spacing_um = float(scan_spacing_um)
+        self.pixel_width_um = float(pixel_width_um)
+        self.pixel_depth_um = float(pixel_depth_um)
+        self.areas_mm2: List[float] = []
+        self._volume_mm3 = 0.0
+
+    def add(self, depth_profile: np.ndarray) -> float:
+        area = slice_area_mm2(depth_profile, self.pixel_width_um, self.pixel_depth_um)
+        if self.areas_mm2:
+            # Trapezoid between this slice and the previous one (mm² * mm = mm³)
+            self._volume_mm3 += 0.5 * (self.areas_mm2[-1] + area) * self.scan_spacing_um / 1000.0
+        self.areas_mm2.append(area)
+        return area
+
+    def extend(self, depth_profiles: Iterable[np.ndarray]) -> "VolumeAccumulator":
+        for profile in depth_profiles:
+            self.add(profile)
+        return self
+
+    def replace(self, index: int, depth_profile: np.ndarray) -> float:
+        """
+        Swap in a new depth profile for slice `index` and patch the volume in
+        O(1): the slice's area only enters the trapezoids on either side of it.
+        """
+        area = slice_area_mm2(depth_profile, self.pixel_width_um, self.pixel_depth_um)
+        n = len(self.areas_mm2)
+        weight = 0.0 if n < 2 else (0.5 if index in (0, n - 1) else 1.0)
+        self._volume_mm3 += weight * (area - self.areas_mm2[index]) * self.scan_spacing_um / 1000.0
+        self.areas_mm2[index] = area
+        return area
+
+    @classmethod
+    def from_areas(cls, areas_mm2: Sequence[float], scan_spacing_um: float, pixel_width_um: float,
+                   pixel_depth_um: float) -> "VolumeAccumulator":
+        """Resume from previously computed slice areas (e.g. a saved case state)."""
+        acc = cls(scan_spacing_um, pixel_width_um, pixel_depth_um)
+        acc.areas_mm2 = [float(a) for a in areas_mm2]
+        if len(acc.areas_mm2) > 1:
+            acc._volume_mm3 = float(_trapezoid(acc.areas_mm2)) * acc.scan_spacing_um / 1000.0
+        return acc
+
+    @property
+    def volume_ul(self) -> float:
+        return self._volume_mm3   # 1 mm³ == 1 µL
+
+    def result(self) -> VolumeResult:
+        return VolumeResult(
+            areas_mm2=list(self.areas_mm2),
+            volume_ul=self.volume_ul,
+            n_slices=len(self.areas_mm2),
+            scan_spacing_um=self.scan_spacing_um,
+        )
+
+
+def integrate_volume(depth_profiles: Iterable[np.ndarray], scan_spacing_um: float,
+                     pixel_width_um: float, pixel_depth_um: float) -> VolumeResult:
+    """Area per slice and total volume (µL) for depth profiles given in slice order."""
+    acc = VolumeAccumulator(scan_spacing_um, pixel_width_um, pixel_depth_um)
+    return acc.extend(depth_profiles).result()
+
+
+# ===== SOURCES OF DEPTH PROFILES =====
+def iter_depth_profiles(source: Union[Sequence[Path], np.ndarray], params: SegmentationParams = SegmentationParams(),
+                        chunk_size: int = 8) -> Iterator[np.ndarray]:
+    """
+    Segment a case `chunk_size` slices at a time and yield one depth profile
+    (px) per slice. `source` is either the B-scan files or an (n, H, W) stack,
+    typically a memory-mapped volume from volume_store. Every segmentation
+    stage is per-slice, so chunking gives the same profiles as segmenting the
+    whole stack while bounding peak memory.
+    """
+    for start in range(0, len(source), chunk_size):
+        chunk = source[start:start + chunk_size]
+        stack = chunk if isinstance(chunk, np.ndarray) else read_stack(chunk)
+        yield from segment_stack(stack, params).depth
+
+
+def case_volume(source: Union[Sequence[Path], np.ndarray], scan_length_um: float, pixel_width_um: float,
+                pixel_depth_um: float, params: SegmentationParams = SegmentationParams(),
+                chunk_size: int = 8) -> VolumeResult:
+    """Segment and integrate a whole case from its B-scan files or a packed volume."""
+    spacing = scan_spacing_um(scan_length_um, len(source))
+    return integrate_volume(iter_depth_profiles(source, params, chunk_size),
+                            spacing, pixel_width_um, pixel_depth_um)
+
+
+def surface_volume(x: np.ndarray, y: np.ndarray, z: np.ndarray, x_unit_um: float = 1.0,
+                   y_unit_um: float = 1.0, z_unit_um: float = 1.0) -> VolumeResult:
+    """
+    Volume under an exported depth surface (one row per B-scan, as in the
+    `surface` traces of images/heatmaps_json). `x`/`y` are the axis vectors or
+    full grids; the *_unit_um factors convert each axis to µm.
+    """
+    z = np.asarray(z, dtype=np.float64)
+    xs = np.asarray(x, dtype=np.float64)
+    ys = np.asarray(y, dtype=np.float64)
+    xs = xs[0] if xs.ndim == 2 else xs
+    ys = ys[:, 0] if ys.ndim == 2 else ys
+    # Surfaces are exported on uniform grids; take the mean step of each axis
+    dx = abs(float(xs[-1] - xs[0])) / max(len(xs) - 1, 1) * x_unit_um
+    dy = abs(float(ys[-1] - ys[0])) / max(len(ys) - 1, 1) * y_unit_um
+    # The whole grid is in memory already: one vectorized pass instead of a slice-by-slice loop
+    z = np.nan_to_num(z, nan=0.0)
+    areas = _trapezoid(z, axis=1) * dx * z_unit_um / UM2_PER_MM2 if z.shape[1] > 1 else np.zeros(len(z))
+    volume = float(_trapezoid(areas)) * dy / 1000.0 if len(areas) > 1 else 0.0
+    return VolumeResult(areas_mm2=areas.tolist(), volume_ul=volume, n_slices=len(areas), scan_spacing_um=dy)
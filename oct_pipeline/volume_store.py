@@ -0,0 +1,163 @@
+# oct_pipeline/volume_store.py
+# Packs an acquisition into one contiguous single-channel volume file.
+#
+# Source B-scans are RGB(A) TIFFs of grayscale OCT data, so every pixel is
+# stored three or four times and has to go through a PIL decode on each read.
+# pack_acquisition() reads every frame of every slice (multi-frame TIFFs
+# included) once and writes:
+#   <name>.npy        uint8 (n_frames, H, W) volume; the .npy header is the small header
+#   <name>.json       per-frame provenance (source file, frame index, size, mtime, sha256)
+# open_volume() memory-maps the .npy, so downstream stages slice frames
+# zero-copy with a third (or a quarter) of the memory of the RGB(A) sources.
+
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps, ImageSequence
+
+from .disk_cache import temp_path
+
+VOLUME_VERSION = 1
+# Max |R-G| / |G-B| still considered gray (JPEG-ish noise); above it the slice carries colour overlays
+GRAY_TOLERANCE = 8
+
+
+def default_volume_path(seg_dir: Path) -> Path:
+    """images/oct_segmentation<N>/ -> images/oct_volumes/oct_segmentation<N>.npy"""
+    seg_dir = Path(seg_dir)
+    return seg_dir.parent / "oct_volumes" / (seg_dir.name + ".npy")
+
+
+def volume_meta_path(volume_path: Path) -> Path:
+    return Path(volume_path).with_suffix(".json")
+
+
+def _frame_sizes(paths: Sequence[Path]) -> List[Tuple[int, Tuple[int, int]]]:
+    """(n_frames, (W, H)) of each source, from headers only."""
+    out = []
+    for p in paths:
+        with Image.open(p) as img:
+            out.append((getattr(img, "n_frames", 1), ImageOps.exif_transpose(img).size))
+    return out
+
+
+def _is_gray(frame: Image.Image) -> bool:
+    if frame.mode in ("L", "I;16", "I", "F", "1"):
+        return True
+    rgb = np.asarray(frame.convert("RGB"), dtype=np.int16)
+    return bool(np.abs(rgb[..., 0] - rgb[..., 1]).max() <= GRAY_TOLERANCE
+                and np.abs(rgb[..., 1] - rgb[..., 2]).max() <= GRAY_TOLERANCE)
+
+
+def pack_acquisition(paths: Sequence[Path], volume_path: Path) -> Path:
+    """
+    Stream every frame of `paths` (in order) into a uint8 (n_frames, H, W)
+    volume at `volume_path` (.npy). All frames must share one size.
+    """
+    paths = [Path(p) for p in paths]
+    if not paths:
+        raise ValueError("pack_acquisition needs at least one slice")
+    sizes = _frame_sizes(paths)
+    width, height = sizes[0][1]
+    for p, (_, size) in zip(paths, sizes):
+        if size != (width, height):
+            raise ValueError(f"{p.name} is {size[0]}x{size[1]}, expected {width}x{height}")
+    n_frames = sum(n for n, _ in sizes)
+
+    volume_path = Path(volume_path)
+    volume_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_path(volume_path).with_suffix(".npy")   # several packers (app, CLI) may write one case
+    vol = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.uint8, shape=(n_frames, height, width))
+
+    frames = []
+    gray = True
+    i = 0
+    for p in paths:
+        data = p.read_bytes()
+        st = p.stat()
+        digest = hashlib.sha256(data).hexdigest()
+        with Image.open(io.BytesIO(data)) as img:
+            for k, frame in enumerate(ImageSequence.Iterator(img)):
+                frame = ImageOps.exif_transpose(frame)
+                gray = gray and _is_gray(frame)
+                vol[i] = np.asarray(frame.convert("L"))
+                frames.append({"source": p.name, "frame": k, "size": st.st_size,
+                               "mtime_ns": st.st_mtime_ns, "sha256": digest})
+                i += 1
+    vol.flush()
+    del vol
+    os.replace(tmp, volume_path)
+
+    meta = {"version": VOLUME_VERSION, "shape": [n_frames, height, width], "grayscale": gray, "frames": frames}
+    meta_tmp = temp_path(volume_meta_path(volume_path))
+    with open(meta_tmp, "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(meta_tmp, volume_meta_path(volume_path))
+    return volume_path
+
+
+def read_volume_meta(volume_path: Path) -> Optional[dict]:
+    try:
+        with open(volume_meta_path(volume_path), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == VOLUME_VERSION else None
+
+
+def open_volume(volume_path: Path) -> np.memmap:
+    """Zero-copy, read-only (n_frames, H, W) view of a packed acquisition."""
+    return np.load(volume_path, mmap_mode="r")
+
+
+def volume_is_fresh(volume_path: Path, paths: Sequence[Path]) -> bool:
+    """True if the volume was packed from exactly these sources and none changed since (size/mtime)."""
+    meta = read_volume_meta(volume_path)
+    if meta is None or not Path(volume_path).exists():
+        return False
+    packed = {}
+    for fr in meta["frames"]:
+        packed.setdefault(fr["source"], (fr["size"], fr["mtime_ns"]))
+    if [Path(p).name for p in paths] != list(packed):
+        return False
+    for p in paths:
+        st = Path(p).stat()
+        if packed[Path(p).name] != (st.st_size, st.st_mtime_ns):
+            return False
+    return True
+
+
+def packed_frames(volume_path: Path, paths: Sequence[Path]) -> Dict[str, Tuple[int, str]]:
+    """
+    {source name: (first frame index, sha256)} for the sources among `paths`
+    that are in the volume and unchanged since it was packed (size/mtime).
+    Sources missing from the pack (strays left out of it, new slices) are omitted.
+    """
+    meta = read_volume_meta(volume_path)
+    if meta is None or not Path(volume_path).exists():
+        return {}
+    packed: Dict[str, Tuple[int, dict]] = {}
+    for i, fr in enumerate(meta["frames"]):
+        packed.setdefault(fr["source"], (i, fr))
+    out = {}
+    for p in paths:
+        hit = packed.get(Path(p).name)
+        if hit is None:
+            continue
+        st = Path(p).stat()
+        idx, fr = hit
+        if (fr["size"], fr["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+            out[Path(p).name] = (idx, fr["sha256"])
+    return out
+
+
+def ensure_volume(paths: Sequence[Path], volume_path: Path) -> Path:
+    """Pack the acquisition unless an up-to-date volume already exists."""
+    if not volume_is_fresh(volume_path, paths):
+        pack_acquisition(paths, volume_path)
+    return Path(volume_path)
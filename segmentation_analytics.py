@@ -39,13 +39,34 @@
 # segmentation_analytics.py
 # Fast Streamlit app: 3D Lesion Topography + super-snappy carousel via WebP previews
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
+import functools
+import io
 import json
-import plotly.io as pio
-from PIL import Image, ImageOps
+import os
+import threading
+import time
+import numpy as np
 import streamlit as st
 
+from oct_pipeline import heatmaps
+from oct_pipeline import previews as preview_pipeline
+from oct_pipeline.cli import uniform_slices
+from oct_pipeline.curvature import curvature_figure, curvature_heatmap, curvature_map, curvature_summary
+from oct_pipeline.disk_cache import DiskCache
+from oct_pipeline.enface import METHOD_LABELS, METHODS, volume_by_method
+from oct_pipeline.ingest import Geometry, IngestManager, Upload, ingested_geometry
+from oct_pipeline.longitudinal import compare_visits, difference_figure
+from oct_pipeline.mesh import heatmap_mesh, write_ply, write_stl
+from oct_pipeline.metrics import METRICS
+from oct_pipeline.registry import CaseRecord, CaseRegistry, cached_depth_map, heatmap_stem, load_depth_map, load_figure
+from oct_pipeline.segmentation import SegmentationParams, overlay_contours, read_stack, segment_gradient, sobel_y
+from oct_pipeline.slice_cache import SliceCache
+from oct_pipeline.tiles import load_pyramid, pyramid_dir, viewport
+
 # ===== PAGE CONFIG =====
 st.set_page_config(
     page_title="3D Lesion Topography",
@@ -56,81 +77,511 @@ st.set_page_config(
 # ===== PATHS =====
 BASE = Path(__file__).resolve().parent
 IMG_DIR = BASE / "images"
-JSON_MAP= IMG_DIR / "heatmaps_json"
-SEG_DIR = IMG_DIR / "oct_segmentation1" 
-SEG_DIR2 = IMG_DIR / "oct_segmentation2"
-SEG_DIR3 = IMG_DIR / "oct_segmentation3"
-PREV_DIR = IMG_DIR / "oct_segmentation_previews1"      # auto-generated WebP previews
-PREV_DIR2 = IMG_DIR / "oct_segmentation_previews2" 
-PREV_DIR3 = IMG_DIR / "oct_segmentation_previews3" 
-PREV_DIR.mkdir(parents=True, exist_ok=True)
-
-ALLOWED_EXTS = (".tif", ".tiff", ".png", ".jpg", ".jpeg")
-FIG_JSON = JSON_MAP / "3d_heatmap.json"
-FIG_JSON2 = JSON_MAP / "3d_heatmap2.json"
-FIG_JSON3 = JSON_MAP / "3d_heatmap3.json"
-FIG_JSON4 = JSON_MAP / "3d_heatmap4.json"
-FIG_JSON5 = JSON_MAP / "3d_heatmap5.json"
-FIG_JSON6 = JSON_MAP / "3d_heatmap6.json"
+# Cases are discovered under IMG_DIR by oct_pipeline.registry:
+#   oct_segmentation<N>/           source B-scans
+#   oct_segmentation_previews<N>/  auto-generated WebP previews
+#   heatmaps_npy/3d_heatmap<N>.*   depth map (python -m oct_pipeline.heatmaps images/heatmaps_json images/heatmaps_npy)
+#   heatmaps_json/3d_heatmap<N>.json  Plotly export, used when no binary depth map exists
+
+FLUO_CAPTION = "Slit-lamp photograph showing a corneal ulcer highlighted with fluorescein dye under cobalt blue illumination."
+SLIT_CAPTION = "Corneal ulcer observed under slit-lamp"
+
+# Per-case presentation that cannot be derived from the scans
+CASE_EXTRAS = {
+    1: dict(aspect_x=1.2, photos=[("ulcer_fluo.png", FLUO_CAPTION), ("slit_lamp.png", SLIT_CAPTION)]),
+    2: dict(aspect_x=2, photos=[("ulcer_fluo2.png", FLUO_CAPTION), ("slit_lamp2.png", SLIT_CAPTION)]),
+    3: dict(aspect_x=2, photos=[("oct_section3.png", None)]),
+    4: dict(aspect_x=2, photos=[("oct_section4.png", None)]),
+    5: dict(aspect_x=2, photos=[("oct_section5.png", None)]),
+    6: dict(aspect_x=2, photos=[("oct_section6.png", None)]),
+}
+DEFAULT_EXTRAS = dict(aspect_x=2, photos=[])
+
+# Acquisition geometry assumed for cases that were not uploaded through the app
+DEFAULT_GEOMETRY = Geometry(scan_length_um=4820.0, pixel_width_um=9.4, pixel_depth_um=3.5)
+
+TILE_SIZE = 256               # tile pyramid used by the native-resolution viewer
+GALLERY_MAX_DIM = 600         # gallery previews (longest side, px) and their WebP quality
+GALLERY_QUALITY = 70
+ZOOM_VIEW = (640, 360)        # viewer size, in pixels of the displayed level
+ZOOM_QUALITY = 90             # JPEG quality of the zoom viewport (st.image would send quality 100)
+
+# Figures and preview listings shared by every app process on this machine (LRU, size-bounded)
+CACHE_DIR = Path(os.environ.get("OCT_CACHE_DIR", BASE / ".oct_cache"))
+CACHE_MAX_MB = int(os.environ.get("OCT_CACHE_MAX_MB", "512"))
+
+# Prometheus text file refreshed after every rerun (e.g. for node_exporter's textfile collector)
+METRICS_TEXTFILE = os.environ.get("OCT_METRICS_TEXTFILE")
+
+# Everything timed / counted from here on is attributed to this rerun (see the sidebar debug panel)
+METRICS.begin_run()
+
+
+# ===== INSTRUMENTATION =====
+_cache_state = threading.local()
+
+def instrumented_cache(loader: str, **cache_kwargs):
+    """
+    st.cache_data that also times every call and counts hits / misses per loader.
+    The wrapped body only runs on a miss, which is how a miss is detected.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def body(*args, **kwargs):
+            _cache_state.missed = True
+            with METRICS.timer("loader_compute_seconds", loader=loader):
+                return fn(*args, **kwargs)
+        cached = st.cache_data(**cache_kwargs)(body)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            outer = getattr(_cache_state, "missed", False)   # loaders may call each other
+            _cache_state.missed = False
+            try:
+                with METRICS.timer("stage_seconds", stage=loader):
+                    return cached(*args, **kwargs)
+            finally:
+                METRICS.inc("cache_requests_total", loader=loader,
+                            result="miss" if _cache_state.missed else "hit")
+                _cache_state.missed = outer
+        wrapper.clear = cached.clear
+        return wrapper
+    return decorate
+
+def show_image(path: Path, container=st, **kwargs) -> None:
+    """st.image for a file on disk, counting the bytes sent to the browser."""
+    METRICS.inc("payload_bytes_total", os.path.getsize(path), kind="image")
+    container.image(str(path), **kwargs)
 
 
 
 # ===== CACHED LOADERS =====
-@st.cache_data(show_spinner=True)
-def load_plotly_fig(json_path: Path):
-    with open(json_path, "r") as f:
-        return pio.from_json(f.read())
-
-@st.cache_data(show_spinner=True)
-def list_source_slices(seg_dir: Path) -> List[Path]:
-    if not seg_dir.exists():
-        return []
-    files = [p for p in seg_dir.iterdir() if p.suffix.lower() in ALLOWED_EXTS]
-    files.sort(key=lambda p: p.name)
-    return files
-
-@st.cache_data(show_spinner=True)
-def build_previews(seg_dir: Path, prev_dir: Path, max_dim: int = 1000, quality: int = 80) -> List[Path]:
+@st.cache_resource
+def case_registry() -> CaseRegistry:
+    return CaseRegistry(IMG_DIR)
+
+@st.cache_resource
+def disk_cache() -> DiskCache:
+    return DiskCache(CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 * 1024, name="app")
+
+@instrumented_cache("load_cases", ttl=30, show_spinner=False)
+def load_cases() -> List[CaseRecord]:
+    """Indexed cases; the folders are re-checked (incrementally) at most every 30 s."""
+    registry = case_registry()
+    registry.refresh()
+    return registry.cases()
+
+def load_plotly_fig(heatmap_path: Path, full_res: bool = False, interp: Optional[str] = None):
     """
-    Ensure every source image has a WebP preview; return sorted list of preview paths.
-    This only runs when new files appear; otherwise it’s a no-op (cached).
+    3D topography figure (registry.load_figure, also timed by the benchmarks).
+    The depth map comes from the shared disk cache (no parsing, no unpickling
+    of a whole figure); only the lightweight Figure object is built.
     """
-    prev_dir.mkdir(parents=True, exist_ok=True)
-    srcs = list_source_slices(seg_dir)
+    with METRICS.timer("stage_seconds", stage="load_plotly_fig"):
+        return load_figure(heatmap_path, disk_cache(), full_res=full_res, interp=interp)
 
-    preview_paths: List[Path] = []
-    for src in srcs:
-        # One-to-one mapping: <name>.webp
-        dest = prev_dir / (src.stem + ".webp")
-        if not dest.exists() or dest.stat().st_mtime < src.stat().st_mtime:
-            # (Re)generate preview
-            img = Image.open(src)
+def figure_layout(case: CaseRecord) -> dict:
+    extras = CASE_EXTRAS.get(case.case_id, DEFAULT_EXTRAS)
+    return dict(template=None, width=800, height=600,
+                scene=dict(aspectmode="manual", aspectratio=dict(x=extras["aspect_x"], y=1, z=0.15)))
 
-            # Multi-frame TIFF: use first frame for speed
-            if getattr(img, "n_frames", 1) > 1:
-                try:
-                    img.seek(0)
-                except Exception:
-                    pass
+@st.cache_resource(max_entries=32, show_spinner=False)
+def topography_figure(heatmap_path: Path, mtime_ns: int, full_res: bool, interp: Optional[str], layout: dict):
+    """
+    The case's topography figure with its layout applied, built once per
+    process and shared by every session, and the size of its serialized spec
+    (what st.plotly_chart sends on every rerun). st.plotly_chart copies the
+    figure before serializing, so the cached Figure is never mutated.
+    """
+    import plotly.io as pio
+
+    fig = load_plotly_fig(heatmap_path, full_res=full_res, interp=interp)
+    fig.update_layout(**layout)
+    return fig, len(pio.to_json(fig, validate=False))
+
+@instrumented_cache("enface_volumes", max_entries=16, show_spinner=False)
+def enface_volumes(heatmap_path: Path, mtime_ns: int) -> dict:
+    """Lesion volume (µL) of the raw slices and of each interpolation, on the full-resolution map."""
+    return volume_by_method(load_depth_map(heatmap_path))
+
+def interp_caption(volumes: dict) -> str:
+    base = volumes["slices"]
+    parts = [f"raw slices {base:.3f} µL"]
+    for method in METHODS:
+        delta = (volumes[method] - base) / base if base else 0.0
+        parts.append(f"{METHOD_LABELS[method]} {volumes[method]:.3f} µL ({delta:+.1%})")
+    return "Volume by interpolation: " + " · ".join(parts)
+
+def volume_subtitle(case: CaseRecord) -> str:
+    if case.volume_ul is None:
+        return "Estimated volume unavailable (no depth map)"
+    return f"Estimated volume of {case.volume_ul:.2f} µL using {case.volume_scans} scans"
+
+@instrumented_cache("list_source_slices", ttl=30, show_spinner=False)
+def list_source_slices(case_id: int) -> List[Path]:
+    return [s.path for s in case_registry().slices(case_id)]
+
+@instrumented_cache("mesh_bytes", max_entries=4, show_spinner=True)
+def mesh_bytes(heatmap_path: Path, mtime_ns: int, fmt: str) -> bytes:
+    """Full-resolution lesion mesh (µm) as binary STL or PLY."""
+    buf = io.BytesIO()
+    (write_stl if fmt == "stl" else write_ply)(heatmap_mesh(load_depth_map(heatmap_path)), buf)
+    return buf.getvalue()
+
+@instrumented_cache("slice_gradient", max_entries=16, show_spinner=False)
+def slice_gradient(path: Path, mtime_ns: int, ksize: int):
+    """Grayscale slice and its Sobel-Y gradient: the only costly stage, and it depends on ksize alone."""
+    gray = read_stack([path])[0]
+    return gray, sobel_y(gray[None], ksize)[0]
+
+@instrumented_cache("case_curvature", max_entries=8, show_spinner=True)
+def case_curvature(case_id: int, listing: Tuple[Tuple[str, int], ...], geometry: Geometry):
+    """
+    Anterior curvature map (heatmaps.Heatmap, 1/mm) and summary radii of a case.
+    Per-slice segmentations are shared through the content-addressed slice cache,
+    so only new or replaced B-scans are segmented again.
+    """
+    kept, _ = uniform_slices(list_source_slices(case_id))
+    digests = [preview_pipeline.file_digest(p) for p in kept]
+    results = SliceCache(CACHE_DIR / "segmentation", SegmentationParams()).segment(kept, digests)
+    # The results live under the disk cache root and count against its size limit (an upper bound:
+    # cached slices were not written again)
+    disk_cache().maybe_evict(sum(rows.nbytes for rows in results.values()))
+    smoothed = np.stack([results[sha][1] for sha in digests])
+    k = curvature_map(smoothed, geometry.pixel_width_um, geometry.pixel_depth_um)
+    spacing = geometry.scan_length_um / max(len(kept) - 1, 1)
+    hm = curvature_heatmap(k, np.arange(k.shape[1]) * geometry.pixel_width_um, np.arange(len(kept)) * spacing)
+    return hm, curvature_summary(k)
+
+@instrumented_cache("visit_comparison", max_entries=8, show_spinner=True)
+def visit_comparison(heatmap_paths: Tuple[Path, ...], mtimes_ns: Tuple[int, ...]):
+    """Follow-ups registered on the first (baseline) visit; one batched FFT for all of them."""
+    maps = [load_depth_map(p) for p in heatmap_paths]
+    return compare_visits(maps[0], maps[1:])
+
+def build_previews(seg_dir: Path, prev_dir: Path, max_dim: int = 1000, quality: int = 80,
+                   tile_size: Optional[int] = TILE_SIZE) -> List[Path]:
+    """
+    Ensure every source image has a WebP preview (and tile pyramid); return sorted list of preview paths.
+    Stale previews are rebuilt in parallel; the listing is served from the shared disk cache otherwise.
+    """
+    with METRICS.timer("stage_seconds", stage="build_previews"):
+        return preview_pipeline.cached_build_previews(disk_cache(), seg_dir, prev_dir, max_dim=max_dim,
+                                                      quality=quality, tile_size=tile_size)
+
+
+# ===== UPLOADS =====
+@st.cache_resource
+def ingest_manager() -> IngestManager:
+    # One per server process: shared by every session, so identical uploads are computed once
+    # Uploads never take an id with curated photos in CASE_EXTRAS (those belong to other patients)
+    return IngestManager(IMG_DIR, first_case_id=max(CASE_EXTRAS) + 1, max_dim=GALLERY_MAX_DIM,
+                         quality=GALLERY_QUALITY, tile_size=TILE_SIZE)
+
+def render_upload() -> None:
+    with st.expander("➕ Add an acquisition"):
+        files = st.file_uploader("B-scans (.tif/.png/.jpg), or a .zip of them", accept_multiple_files=True,
+                                 type=["zip", "tif", "tiff", "png", "jpg", "jpeg"], key="upload_files")
+        c1, c2, c3 = st.columns(3)
+        scan_length = c1.number_input("Scan length (µm)", min_value=1.0, value=DEFAULT_GEOMETRY.scan_length_um,
+                                      key="upload_scan_length")
+        pixel_width = c2.number_input("Pixel width (µm)", min_value=0.01, value=DEFAULT_GEOMETRY.pixel_width_um,
+                                      key="upload_pixel_width")
+        pixel_depth = c3.number_input("Pixel depth (µm)", min_value=0.01, value=DEFAULT_GEOMETRY.pixel_depth_um,
+                                      key="upload_pixel_depth")
+        if st.button("Process", disabled=not files, key="upload_submit"):
+            job = ingest_manager().submit([Upload(f.name, f.getvalue()) for f in files],
+                                          Geometry(scan_length, pixel_width, pixel_depth))
+            st.session_state.setdefault("ingest_seen", {})[job.digest] = job.status
+
+        active = any(job.active for job in ingest_manager().jobs())
+        # Only the job list reruns while a job is in flight; the rest of the page stays put
+        st.fragment(render_ingest_jobs, run_every=1.0 if active else None)()
+
+def render_ingest_jobs() -> None:
+    seen = st.session_state.setdefault("ingest_seen", {})
+    jobs = [job for job in ingest_manager().jobs() if job.digest in seen or job.active]
+    for job in jobs:
+        if job.status == "failed":
+            st.error(f"Case {job.case_id} ({job.label}) failed: {job.error}")
+        elif job.status == "done":
+            st.success(f"Case {job.case_id} ({job.label}): {job.n_slices} slices, "
+                       f"{job.volume_ul:.2f} µL")
+        else:
+            st.progress(job.progress, text=f"Case {job.case_id} ({job.label}): {job.stage or job.status}…")
+    finished = [job for job in jobs if job.status == "done" and seen.get(job.digest) != "done"]
+    for job in jobs:
+        seen[job.digest] = job.status
+    if finished:
+        load_cases.clear()
+        st.rerun(scope="app")
+
+
+# ===== CASES =====
+@st.cache_resource
+def _prefetch_pool():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="case-prefetch"), set()
+
+def _warm_case(case: CaseRecord, cache: DiskCache) -> None:
+    # Fill the disk-cache entries the next rerun reads (gallery listing, coarse depth map).
+    # No Streamlit calls off the script thread: the cache is passed in.
+    preview_pipeline.cached_build_previews(cache, case.seg_dir, case.prev_dir, workers=1,
+                                           max_dim=GALLERY_MAX_DIM, quality=GALLERY_QUALITY,
+                                           tile_size=TILE_SIZE)
+    if case.heatmap is not None:
+        cached_depth_map(case.heatmap, cache)   # what load_plotly_fig starts from
+
+def prefetch_case(case: CaseRecord) -> None:
+    """Warm the next likely case in a background thread, once per server process."""
+    pool, submitted = _prefetch_pool()
+    if case.case_id not in submitted:
+        submitted.add(case.case_id)
+        pool.submit(_warm_case, case, disk_cache())
+
+
+def render_gallery(seg_dir: Path, prev_dir: Path) -> None:
+    # Build/get previews once (cached); also keeps the case's sprite sheet up to date
+    previews = build_previews(seg_dir, prev_dir, max_dim=GALLERY_MAX_DIM, quality=GALLERY_QUALITY)
 
-            # Fix orientation, convert to RGB
-            img = ImageOps.exif_transpose(img)
-            if img.mode not in ("RGB", "L"):
-                img = img.convert("RGB")
+    if not previews:
+        st.info(
+            f"No source images found in `{seg_dir}`.\n"
+            f"Add .tif/.tiff/.png/.jpg files there. Previews will appear in `{prev_dir}`."
+        )
+        return
+
+    # Overview: every slice in one sprite image (a single request whatever the slice count)
+    sprite = prev_dir / preview_pipeline.SPRITE_NAME
+    if sprite.exists():
+        show_image(sprite, caption=f"All {len(previews)} slices, in order, row by row",
+                   use_container_width=True)
+
+    # --- PARAMETERS ---
+    n_cols = 3      # number of images per row
+    page_size = 9   # full-size previews loaded per page
+
+    # Only the visible page of full-size previews is sent to the browser
+    first = 1
+    if len(previews) > page_size:
+        first = st.slider("First slice shown", 1, len(previews), 1, step=page_size,
+                          key=f"gallery_{prev_dir.name}")
+    page = previews[first - 1:first - 1 + page_size]
+    st.caption(f"Slices {first}–{first - 1 + len(page)} of {len(previews)}")
+
+    # Split list of images into rows of n_cols
+    rows = [page[i:i + n_cols] for i in range(0, len(page), n_cols)]
+
+    # Display each row
+    for row in rows:
+        cols = st.columns(len(row))
+        for col, img_path in zip(cols, row):
+            show_image(img_path, col,
+                       caption=img_path.name,
+                       use_container_width=True)
+
+    render_zoom_viewer(prev_dir, previews)
+
+
+def render_zoom_viewer(prev_dir: Path, previews: List[Path]) -> None:
+    """Zoom/pan into one slice at native resolution, reading only the tiles in view."""
+    if not st.toggle("🔍 Inspect a slice at native resolution", key=f"zoom_{prev_dir.name}"):
+        return
+    names = [p.stem for p in previews]
+    name = st.selectbox("Slice", names, key=f"zoom_slice_{prev_dir.name}")
+    tiles_root = pyramid_dir(Path(name), prev_dir / preview_pipeline.TILES_DIR_NAME)
+    if not tiles_root.exists():
+        st.info("No tile pyramid for this slice yet; it is built with the previews.")
+        return
+    pyr = load_pyramid(tiles_root)
+
+    levels = list(range(len(pyr.levels) - 1, -1, -1))   # coarsest first
+    c1, c2, c3 = st.columns(3)
+    level = c1.select_slider("Zoom", options=levels, value=0, key=f"zoom_level_{prev_dir.name}",
+                             format_func=lambda lv: f"{100 / 2 ** lv:.0f}%")
+    cx = c2.slider("Pan ←→", 0.0, 1.0, 0.5, key=f"zoom_x_{prev_dir.name}")
+    cy = c3.slider("Pan ↑↓", 0.0, 1.0, 0.5, key=f"zoom_y_{prev_dir.name}")
+
+    with METRICS.timer("stage_seconds", stage="zoom_viewport"):
+        img, box, n_tiles = viewport(pyr, level, (cx, cy), ZOOM_VIEW)
+    # Encoded here so the counted bytes are the ones sent: st.image passes a JPEG narrower than
+    # the page through as is
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=ZOOM_QUALITY)
+    METRICS.inc("payload_bytes_total", buf.tell(), kind="viewport")
+    scale = 2 ** level
+    st.image(buf.getvalue(), caption=f"{name}: x {box[0] * scale}–{box[2] * scale}, y {box[1] * scale}–{box[3] * scale} "
+                          f"of {pyr.width}×{pyr.height} px ({n_tiles} tiles read)")
+
+
+def render_mesh_export(case: CaseRecord) -> None:
+    """Download the lesion as a watertight mesh; built only once the export is opened."""
+    if not st.toggle("⬇️ Export lesion mesh for bioprinting", key=f"mesh_{case.case_id}"):
+        return
+    fmt = st.radio("Format", ["stl", "ply"], horizontal=True, key=f"mesh_fmt_{case.case_id}",
+                   format_func=str.upper)
+    data = mesh_bytes(case.heatmap, case.heatmap.stat().st_mtime_ns, fmt)
+    METRICS.inc("payload_bytes_total", len(data), kind="mesh")
+    st.download_button(f"Download {fmt.upper()} ({len(data) / 1e6:.1f} MB, µm)", data,
+                       file_name=f"lesion_case{case.case_id}.{fmt}",
+                       mime="model/stl" if fmt == "stl" else "application/octet-stream",
+                       key=f"mesh_download_{case.case_id}")
+
+
+def render_curvature(case: CaseRecord) -> None:
+    """Anterior curvature map of every slice, with the case's summary radii."""
+    if not st.toggle("📐 Corneal curvature", key=f"curvature_{case.case_id}"):
+        return
+    slices = list_source_slices(case.case_id)
+    if not slices:
+        st.info("No source slices to measure curvature on.")
+        return
+    geometry = ingested_geometry(case.seg_dir) or DEFAULT_GEOMETRY
+    listing = tuple((p.name, p.stat().st_mtime_ns) for p in slices)
+    hm, summary = case_curvature(case.case_id, listing, geometry)
+    radius = lambda r: "flat / concave" if r == float("inf") else f"{r:.2f} mm"
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Radius", radius(summary.radius_mm))
+    c2.metric("Steepest", radius(summary.steep_radius_mm))
+    c3.metric("Flattest", radius(summary.flat_radius_mm))
+    c4.metric("Coverage", f"{summary.coverage:.0%}")
+    fig = curvature_figure(hm)
+    fig.update_layout(width=800, height=400)
+    with METRICS.timer("stage_seconds", stage="plotly_chart"):
+        st.plotly_chart(fig, theme=None, use_container_width=False)
+    st.caption(f"Pixel size {geometry.pixel_width_um:g} × {geometry.pixel_depth_um:g} µm. "
+               "Red is convex, blue concave; blank columns had no contour within the fit window.")
+
+
+def render_tuning_panel(case: CaseRecord) -> None:
+    """Live segmentation of one slice; threshold / window changes re-use the cached gradient."""
+    if not st.toggle("🎛️ Tune segmentation parameters", key=f"tune_{case.case_id}"):
+        return
+    slices = list_source_slices(case.case_id)
+    if not slices:
+        st.info("No source slices to tune on.")
+        return
+    names = [p.name for p in slices]
+    name = st.selectbox("Slice", names, index=len(names) // 2, key=f"tune_slice_{case.case_id}")
+    path = slices[names.index(name)]
+
+    defaults = SegmentationParams()
+    c1, c2, c3 = st.columns(3)
+    ksize = c1.select_slider("Sobel kernel size", options=list(range(3, 32, 2)), value=defaults.ksize,
+                             key=f"tune_ksize_{case.case_id}")
+    threshold = c2.slider("Gradient threshold", 0.0, 0.5, defaults.threshold, step=0.01,
+                          key=f"tune_threshold_{case.case_id}")
+    window = c3.select_slider("Smoothing window", options=list(range(1, 62, 2)), value=defaults.smooth_window,
+                              key=f"tune_window_{case.case_id}")
+    params = replace(defaults, ksize=ksize, threshold=threshold, smooth_window=window)
+
+    t = time.perf_counter()
+    with METRICS.timer("stage_seconds", stage="tuning"):
+        gray, grad = slice_gradient(path, path.stat().st_mtime_ns, ksize)
+        res = segment_gradient(grad, params)
+        overlay = overlay_contours(gray, res.smoothed[0], res.reference[0])
+    st.image(overlay, caption=f"{name}: contour (red), healthy surface (green), lesion (blue) · "
+                              f"{(time.perf_counter() - t) * 1000:.0f} ms", use_container_width=True)
+    st.caption(f"Edge found in {np.isfinite(res.contours[0]).mean():.0%} of columns · "
+               f"max lesion depth {res.depth.max():.1f} px")
+    st.code(f"python -m oct_pipeline images/ --ksize {ksize} --threshold {threshold:g} --smooth-window {window} ...",
+            language="bash")
+
+
+def render_case(case: CaseRecord) -> None:
+    extras = CASE_EXTRAS.get(case.case_id, DEFAULT_EXTRAS)
+    st.subheader(volume_subtitle(case))
+    col1, col2 = st.columns([1, 2])
 
-            # Downscale (keeps aspect ratio)
-            img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+    # Left column: clinical photos (optional)
+    with col1:
+        for name, caption in extras["photos"]:
+            img = IMG_DIR / name
+            if img.exists():
+                show_image(img, caption=caption, use_container_width=True)
 
-            # Save as WebP for tiny, fast loads
-            img.save(dest, format="WEBP", quality=quality, method=0)  # method=6 is slower once, faster to load
-        preview_paths.append(dest)
+    # Right column: 3D + Carousel
+    with col2:
+        st.header("🌐 3D Lesion Topography")
+        if case.heatmap is not None:
+            full_res = st.toggle("Full-resolution surface", key=f"full_res_{case.case_id}")
+            interp = st.radio("Between B-scans", ["slices", *METHODS], horizontal=True,
+                              format_func=lambda m: METHOD_LABELS.get(m, "Raw slices"),
+                              key=f"interp_{case.case_id}")
+            interp = None if interp == "slices" else interp
+            fig, spec_bytes = topography_figure(case.heatmap, case.heatmap.stat().st_mtime_ns, full_res, interp,
+                                                figure_layout(case))
+            METRICS.inc("payload_bytes_total", spec_bytes, kind="figure")
+            # Copy + serialization of the cached figure, paid on every rerun
+            with METRICS.timer("stage_seconds", stage="topography_chart"):
+                st.plotly_chart(fig, theme=None, use_container_width=False)
+            if interp is not None:
+                st.caption(interp_caption(enface_volumes(case.heatmap, case.heatmap.stat().st_mtime_ns)))
+            render_mesh_export(case)
+            render_curvature(case)
 
-    preview_paths.sort(key=lambda p: p.name)
-    return preview_paths
+        else:
+            st.warning(f"3D visualization not found. Please add: {IMG_DIR / 'heatmaps_npy' / heatmap_stem(case.case_id)}.npy")
 
+        st.divider()
+    st.subheader("🖼️ Segmented OCT slices")
+    with METRICS.timer("stage_seconds", stage="render_gallery"):
+        render_gallery(case.seg_dir, case.prev_dir)
+    render_tuning_panel(case)
+
+
+def render_visit_comparison(cases: List[CaseRecord]) -> None:
+    """Lesion change between visits of one patient: registered difference map, volume and healing rate."""
+    with st.expander("📈 Compare visits"):
+        by_label = {case.label: case for case in cases if case.heatmap is not None}
+        chosen = st.multiselect("Visits of one patient, baseline first", list(by_label), key="visits")
+        if len(chosen) < 2:
+            st.info("Pick a baseline visit and at least one follow-up.")
+            return
+        visits = [by_label[label] for label in chosen]
+        comparisons = visit_comparison(tuple(v.heatmap for v in visits),
+                                       tuple(v.heatmap.stat().st_mtime_ns for v in visits))
+
+        cols = st.columns(len(comparisons))
+        days = [col.number_input(f"Days to {v.label}", min_value=1, value=7 * i, step=1,
+                                 key=f"visit_days_{v.case_id}")
+                for i, (col, v) in enumerate(zip(cols, visits[1:]), start=1)]
+        st.table({
+            "follow-up": [v.label for v in visits[1:]],
+            "shift (µm)": [f"{c.registration.shift_um[1]:+.0f}, {c.registration.shift_um[0]:+.0f}"
+                           for c in comparisons],
+            "match": [f"{c.registration.peak:.2f}" for c in comparisons],
+            "volume (µL)": [f"{c.volume_baseline_ul:.3f} → {c.volume_followup_ul:.3f}" for c in comparisons],
+            "change": [f"{c.volume_delta_ul:+.3f} µL ({c.volume_change:+.0%})" for c in comparisons],
+            "healing rate (µL/day)": [f"{c.healing_rate_ul_per_day(d):.4f}" for c, d in zip(comparisons, days)],
+        })
+        shown = st.selectbox("Difference topography", range(len(comparisons)),
+                             format_func=lambda i: f"{visits[0].label} → {visits[i + 1].label}", key="visit_shown")
+        fig = difference_figure(heatmaps.decimate_columns(comparisons[shown].difference, 2))
+        fig.update_layout(width=800, height=600)
+        with METRICS.timer("stage_seconds", stage="plotly_chart"):
+            st.plotly_chart(fig, theme=None, use_container_width=False)
+        st.caption("Shift is (x, y) applied to the follow-up. Blue: shallower than at baseline, red: deeper. "
+                   "A low match means the maps share little structure; check the visits belong together.")
+
+
+def render_debug_panel() -> None:
+    """Sidebar summary of this rerun, plus the process-wide totals for export."""
+    run = METRICS.current_run()
+    sidebar = st.sidebar
+    sidebar.subheader("This rerun")
+    if run is not None:
+        sidebar.caption(f"{(time.perf_counter() - run.started) * 1000:.0f} ms so far")
+        sidebar.table({"stage": list(run.timings),
+                       "ms": [f"{t * 1000:.1f}" for t in run.timings.values()]})
+        sidebar.table({"counter": list(run.counters),
+                       "value": [f"{v:,.0f}" for v in run.counters.values()]})
+    sidebar.subheader("Process totals")
+    sidebar.download_button("Prometheus text", METRICS.to_prometheus(), file_name="oct_metrics.prom")
+    sidebar.download_button("JSON", json.dumps(METRICS.snapshot(), indent=1), file_name="oct_metrics.json")
 
 
 # ===== MAIN TITLE =====
+debug_metrics = st.sidebar.toggle("Performance debug panel", key="debug_metrics")
 st.title("Automated OCT-based corneal ulcers segmentation and 3D mapping")
 
 # ---- About ----
@@ -153,16 +604,16 @@ to detect problems like scars, ulcers, or swelling.
 """)
 img_intact = IMG_DIR / "intact_oct_scan.png"
 if img_intact.exists():
-    st.image(
-        str(img_intact),
+    show_image(
+        img_intact,
         caption="Normal cornea on OCT: cross-sectional scan selected from a 21-scan acquisition",
         use_container_width=True
     )
 
 img_intact = IMG_DIR / "wound_oct_scan.png"
 if img_intact.exists():
-    st.image(
-        str(img_intact),
+    show_image(
+        img_intact,
         caption="Wounded cornea on OCT: cross-sectional scan selected from a 21-scan acquisition",
         use_container_width=True
     )
@@ -182,22 +633,22 @@ with col1:
 with col2:
     cornea_scan = IMG_DIR / "corneal_original.png"
     if cornea_scan.exists():
-        st.image(
-            str(cornea_scan),
+        show_image(
+            cornea_scan,
             caption="(1) Initial OCT scan with **no corneal contour highlighted**.",
             use_container_width=False
         )
     sobel_op = IMG_DIR / "sobel_final1.png"
     if sobel_op.exists():
-        st.image(
-            str(sobel_op),
+        show_image(
+            sobel_op,
             caption="(2) Edge detection using the Sobel operator to highlight the **anterior corneal contour**.",
             use_container_width=False
         )
     detection_op = IMG_DIR / "detection_sobel.png"
     if detection_op.exists():
-        st.image(
-            str(detection_op),
+        show_image(
+            detection_op,
             caption="(3) Detected contour after applying the Sobel operator.",
             use_container_width=False
         )    
@@ -212,350 +663,21 @@ st.divider()
 
 # ---- Lesion Examples ----
 st.header("Lesion Examples")
-tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(["Corneal Ulcer 1", "Corneal Ulcer 2", "Corneal Ulcer 3", "Corneal Ulcer 4", "Corneal Ulcer 5", "Corneal Ulcer 6", "Validation"])
 
-with tab1:
-    st.subheader("Estimated volume of 0.55 µL using 21 scans")
-    col1, col2 = st.columns([1, 2])
-
-    # Left column: clinical photos (optional)
-    with col1:
-        img1 = IMG_DIR / "ulcer_fluo.png"
-        if img1.exists():
-            st.image(str(img1), caption="Slit-lamp photograph showing a corneal ulcer highlighted with fluorescein dye under cobalt blue illumination.", use_container_width=True)
-        img2 = IMG_DIR / "slit_lamp.png"
-        if img2.exists():
-            st.image(str(img2), caption="Corneal ulcer observed under slit-lamp", use_container_width=True)
-
-    # Right column: 3D + Carousel
-    with col2:
-        st.header("🌐 3D Lesion Topography")
-        if FIG_JSON.exists():
-            fig = load_plotly_fig(FIG_JSON)
-            fig.update_layout(template=None)
-            fig.update_layout(
-                scene=dict(
-                    aspectmode='manual',
-                    aspectratio=dict(x=1.2, y=1, z=0.15)
-                ),
-                width=800,
-                height=600
-            )
-            st.plotly_chart(fig, theme=None, use_container_width=False)
-
-        else:
-            st.warning(f"3D visualization not found. Please add: {FIG_JSON}")
-
-        st.divider()
-    st.subheader("🖼️ Segmented OCT slices")
-        # Build/get previews once (cached)
-    previews = build_previews(SEG_DIR, PREV_DIR, max_dim=600, quality=70)
-
-    if not previews:
-        st.info(
-            f"No source images found in `{SEG_DIR}`.\n"
-            f"Add .tif/.tiff/.png/.jpg files there. Previews will appear in `{PREV_DIR}`."
-        )
-    else:
-        # --- PARAMETERS ---
-        n_cols = 3   # number of images per row
-        max_to_show = 30  # safety cap so you don't overload the page
-        previews = previews[:max_to_show]
-
-        # Split list of images into rows of n_cols
-        rows = [previews[i:i + n_cols] for i in range(0, len(previews), n_cols)]
-
-        # Display each row
-        for row in rows:
-            cols = st.columns(len(row))
-            for col, img_path in zip(cols, row):
-                col.image(str(img_path),
-                        caption=img_path.name,
-                        use_container_width=True)
-
-
-with tab2:
-    st.subheader("Estimated volume of 0.21 µL using 41 scans")
-    col1, col2 = st.columns([1, 2])
-
-    # Left column: clinical photos (optional)
-    with col1:
-        img1 = IMG_DIR / "ulcer_fluo2.png"
-        if img1.exists():
-            st.image(str(img1), caption="Slit-lamp photograph showing a corneal ulcer highlighted with fluorescein dye under cobalt blue illumination.", use_container_width=True)
-        img2 = IMG_DIR / "slit_lamp2.png"
-        if img2.exists():
-            st.image(str(img2), caption="Corneal ulcer observed under slit-lamp", use_container_width=True)
-
-    # Right column: 3D + Carousel
-    with col2:
-        st.header("🌐 3D Lesion Topography")
-        if FIG_JSON.exists():
-            fig = load_plotly_fig(FIG_JSON2)
-            fig.update_layout(template=None)
-            fig.update_layout(
-                scene=dict(
-                    aspectmode='manual',
-                    aspectratio=dict(x=2, y=1, z=0.15)
-                ),
-                width=800,
-                height=600
-            )
-            st.plotly_chart(fig, theme=None, use_container_width=False)
-
-        else:
-            st.warning(f"3D visualization not found. Please add: {FIG_JSON}")
-
-        st.divider()
-    st.subheader("🖼️ Segmented OCT slices")
-        # Build/get previews once (cached)
-    previews = build_previews(SEG_DIR2, PREV_DIR2, max_dim=600, quality=70)
-
-    if not previews:
-        st.info(
-            f"No source images found in `{SEG_DIR}`.\n"
-            f"Add .tif/.tiff/.png/.jpg files there. Previews will appear in `{PREV_DIR}`."
-        )
-    else:
-        # --- PARAMETERS ---
-        n_cols = 3   # number of images per row
-        max_to_show = 30  # safety cap so you don't overload the page
-        previews = previews[:max_to_show]
-
-        # Split list of images into rows of n_cols
-        rows = [previews[i:i + n_cols] for i in range(0, len(previews), n_cols)]
-
-        # Display each row
-        for row in rows:
-            cols = st.columns(len(row))
-            for col, img_path in zip(cols, row):
-                col.image(str(img_path),
-                        caption=img_path.name,
-                        use_container_width=True)
-with tab3:
-    st.subheader("Estimated volume of 1.03 µL using 11 scans")
-    col1, col2 = st.columns([1, 2])
-
-    # Left column: clinical photos (optional)
-    with col1:
-        img1 = IMG_DIR / "oct_section3.png"
-        if img1.exists():
-            st.image(str(img1), use_container_width=True)
-
-
-    # Right column: 3D + Carousel
-    with col2:
-        st.header("🌐 3D Lesion Topography")
-        if FIG_JSON.exists():
-            fig = load_plotly_fig(FIG_JSON3)
-            fig.update_layout(template=None)
-            fig.update_layout(
-                scene=dict(
-                    aspectmode='manual',
-                    aspectratio=dict(x=2, y=1, z=0.15)
-                ),
-                width=800,
-                height=600
-            )
-            st.plotly_chart(fig, theme=None, use_container_width=False)
-
-        else:
-            st.warning(f"3D visualization not found. Please add: {FIG_JSON}")
-
-        st.divider()
-    st.subheader("🖼️ Segmented OCT slices")
-        # Build/get previews once (cached)
-    previews = build_previews(SEG_DIR3, PREV_DIR3, max_dim=600, quality=70)
-
-    if not previews:
-        st.info(
-            f"No source images found in `{SEG_DIR}`.\n"
-            f"Add .tif/.tiff/.png/.jpg files there. Previews will appear in `{PREV_DIR}`."
-        )
-    else:
-        # --- PARAMETERS ---
-        n_cols = 3   # number of images per row
-        max_to_show = 30  # safety cap so you don't overload the page
-        previews = previews[:max_to_show]
-
-        # Split list of images into rows of n_cols
-        rows = [previews[i:i + n_cols] for i in range(0, len(previews), n_cols)]
-
-        # Display each row
-        for row in rows:
-            cols = st.columns(len(row))
-            for col, img_path in zip(cols, row):
-                col.image(str(img_path),
-                        caption=img_path.name,
-                        use_container_width=True)
-# with tab4:
-#     st.subheader("Estimated volume of 0.17 µL using 22 scans")
-#     col1, col2 = st.columns([1, 2])
-
-#     # Left column: clinical photos (optional)
-#     with col1:
-#         img1 = IMG_DIR / "oct_section4.png"
-#         if img1.exists():
-#             st.image(str(img1), use_container_width=True)
-
-
-#     # Right column: 3D + Carousel
-#     with col2:
-#         st.header("🌐 3D Lesion Topography")
-#         if FIG_JSON.exists():
-#             fig = load_plotly_fig(FIG_JSON3)
-#             fig.update_layout(template=None)
-#             fig.update_layout(
-#                 scene=dict(
-#                     aspectmode='manual',
-#                     aspectratio=dict(x=2, y=1, z=0.15)
-#                 ),
-#                 width=800,
-#                 height=600
-#             )
-#             st.plotly_chart(fig, theme=None, use_container_width=False)
-
-#         else:
-#             st.warning(f"3D visualization not found. Please add: {FIG_JSON}")
-
-#         st.divider()
-#     st.subheader("🖼️ Segmented OCT slices")
-#         # Build/get previews once (cached)
-#     previews = build_previews(SEG_DIR3, PREV_DIR3, max_dim=600, quality=70)
-
-#     if not previews:
-#         st.info(
-#             f"No source images found in `{SEG_DIR}`.\n"
-#             f"Add .tif/.tiff/.png/.jpg files there. Previews will appear in `{PREV_DIR}`."
-#         )
-#     else:
-#         # --- PARAMETERS ---
-#         n_cols = 3   # number of images per row
-#         max_to_show = 30  # safety cap so you don't overload the page
-#         previews = previews[:max_to_show]
-
-#         # Split list of images into rows of n_cols
-#         rows = [previews[i:i + n_cols] for i in range(0, len(previews), n_cols)]
-
-#         # Display each row
-#         for row in rows:
-#             cols = st.columns(len(row))
-#             for col, img_path in zip(cols, row):
-#                 col.image(str(img_path),
-#                         caption=img_path.name,
-#                         use_container_width=True)
-# with tab5:
-#     st.subheader("Estimated volume of 0.10 µL using 22 scans")
-#     col1, col2 = st.columns([1, 2])
-
-#     # Left column: clinical photos (optional)
-#     with col1:
-#         img1 = IMG_DIR / "oct_section5.png"
-#         if img1.exists():
-#             st.image(str(img1), use_container_width=True)
-
-
-#     # Right column: 3D + Carousel
-#     with col2:
-#         st.header("🌐 3D Lesion Topography")
-#         if FIG_JSON.exists():
-#             fig = load_plotly_fig(FIG_JSON3)
-#             fig.update_layout(template=None)
-#             fig.update_layout(
-#                 scene=dict(
-#                     aspectmode='manual',
-#                     aspectratio=dict(x=2, y=1, z=0.15)
-#                 ),
-#                 width=800,
-#                 height=600
-#             )
-#             st.plotly_chart(fig, theme=None, use_container_width=False)
-
-#         else:
-#             st.warning(f"3D visualization not found. Please add: {FIG_JSON}")
-
-#         st.divider()
-#     st.subheader("🖼️ Segmented OCT slices")
-#         # Build/get previews once (cached)
-#     previews = build_previews(SEG_DIR3, PREV_DIR3, max_dim=600, quality=70)
-
-#     if not previews:
-#         st.info(
-#             f"No source images found in `{SEG_DIR}`.\n"
-#             f"Add .tif/.tiff/.png/.jpg files there. Previews will appear in `{PREV_DIR}`."
-#         )
-#     else:
-#         # --- PARAMETERS ---
-#         n_cols = 3   # number of images per row
-#         max_to_show = 30  # safety cap so you don't overload the page
-#         previews = previews[:max_to_show]
-
-#         # Split list of images into rows of n_cols
-#         rows = [previews[i:i + n_cols] for i in range(0, len(previews), n_cols)]
-
-#         # Display each row
-#         for row in rows:
-#             cols = st.columns(len(row))
-#             for col, img_path in zip(cols, row):
-#                 col.image(str(img_path),
-#                         caption=img_path.name,
-#                         use_container_width=True)
-# with tab6:
-#     st.subheader("Estimated volume of 0.21 µL using 81 scans")
-#     col1, col2 = st.columns([1, 2])
-
-#     # Left column: clinical photos (optional)
-#     with col1:
-#         img1 = IMG_DIR / "oct_section6.png"
-#         if img1.exists():
-#             st.image(str(img1), use_container_width=True)
-
-
-#     # Right column: 3D + Carousel
-#     with col2:
-#         st.header("🌐 3D Lesion Topography")
-#         if FIG_JSON.exists():
-#             fig = load_plotly_fig(FIG_JSON3)
-#             fig.update_layout(template=None)
-#             fig.update_layout(
-#                 scene=dict(
-#                     aspectmode='manual',
-#                     aspectratio=dict(x=2, y=1, z=0.15)
-#                 ),
-#                 width=800,
-#                 height=600
-#             )
-#             st.plotly_chart(fig, theme=None, use_container_width=False)
-
-#         else:
-#             st.warning(f"3D visualization not found. Please add: {FIG_JSON}")
-
-#         st.divider()
-#     st.subheader("🖼️ Segmented OCT slices")
-#         # Build/get previews once (cached)
-#     previews = build_previews(SEG_DIR3, PREV_DIR3, max_dim=600, quality=70)
-
-#     if not previews:
-#         st.info(
-#             f"No source images found in `{SEG_DIR}`.\n"
-#             f"Add .tif/.tiff/.png/.jpg files there. Previews will appear in `{PREV_DIR}`."
-#         )
-#     else:
-#         # --- PARAMETERS ---
-#         n_cols = 3   # number of images per row
-#         max_to_show = 30  # safety cap so you don't overload the page
-#         previews = previews[:max_to_show]
-
-#         # Split list of images into rows of n_cols
-#         rows = [previews[i:i + n_cols] for i in range(0, len(previews), n_cols)]
-
-#         # Display each row
-#         for row in rows:
-#             cols = st.columns(len(row))
-#             for col, img_path in zip(cols, row):
-#                 col.image(str(img_path),
-#                         caption=img_path.name,
-#                         use_container_width=True)
+render_upload()
+
+# Only the selected case is rendered on a rerun; the next one is warmed in the background
+cases = load_cases()
+if not cases:
+    st.info(f"No cases found. Add B-scans to `{IMG_DIR}/oct_segmentation<N>/`.")
+else:
+    labels = [case.label for case in cases]
+    selected = st.radio("Case", labels, horizontal=True, label_visibility="collapsed")
+    case_idx = labels.index(selected)
+    prefetch_case(cases[(case_idx + 1) % len(cases)])
+    with METRICS.timer("stage_seconds", stage="render_case"):
+        render_case(cases[case_idx])
+    render_visit_comparison(cases)
 
 st.divider()
 
@@ -565,7 +687,8 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
-
-
-
-
+if debug_metrics:
+    render_debug_panel()
+METRICS.end_run()
+if METRICS_TEXTFILE:
+    METRICS.write_textfile(Path(METRICS_TEXTFILE))
@@ -0,0 +1,132 @@
+# tests/test_incremental.py
+# Incremental volume updates (VolumeAccumulator.replace, slice_cache.update_case)
+# must give the same volume as integrating / segmenting the whole case again.
+
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+from oct_pipeline.slice_cache import update_case
+from oct_pipeline.volume import VolumeAccumulator, case_volume, integrate_volume
+from oct_pipeline.volume_store import ensure_volume
+
+CASE_DIR = Path(__file__).resolve().parent.parent / "images" / "oct_segmentation3"
+GEOMETRY = dict(scan_length_um=4820.0, pixel_width_um=9.4, pixel_depth_um=3.5)
+SPACING = dict(scan_spacing_um=482.0, pixel_width_um=9.4, pixel_depth_um=3.5)
+
+
+# ===== VolumeAccumulator =====
+@pytest.mark.parametrize("index", [0, 3, 7])
+def test_replace_matches_full_integration(index):
+    rng = np.random.default_rng(index)
+    profiles = [rng.uniform(0, 40, 300) for _ in range(8)]
+    acc = VolumeAccumulator(**SPACING).extend(profiles)
+
+    profiles[index] = rng.uniform(0, 80, 300)
+    acc.replace(index, profiles[index])
+    full = integrate_volume(profiles, **SPACING)
+    assert acc.volume_ul == pytest.approx(full.volume_ul, rel=1e-12)
+    assert acc.areas_mm2 == pytest.approx(full.areas_mm2, rel=1e-12)
+
+
+def test_replace_after_resume_from_areas():
+    rng = np.random.default_rng(1)
+    profiles = [rng.uniform(0, 40, 300) for _ in range(5)]
+    areas = integrate_volume(profiles, **SPACING).areas_mm2
+    acc = VolumeAccumulator.from_areas(areas, **SPACING)
+
+    profiles[2] = np.zeros(300)
+    acc.replace(2, profiles[2])
+    assert acc.volume_ul == pytest.approx(integrate_volume(profiles, **SPACING).volume_ul, rel=1e-12)
+
+
+# ===== update_case =====
+@pytest.fixture
+def case(tmp_path):
+    seg_dir = tmp_path / "case"
+    shutil.copytree(CASE_DIR, seg_dir)
+    return sorted(seg_dir.iterdir())
+
+
+def _replace_slice(dest: Path, src: Path) -> None:
+    """Overwrite a B-scan with another one's content, as a re-acquired slice would."""
+    dest.write_bytes(src.read_bytes())
+    st = dest.stat()
+    os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+def test_update_case_first_run_matches_case_volume(case, tmp_path):
+    update = update_case(case, tmp_path / "state", **GEOMETRY)
+    assert update.rebuilt
+    assert len(update.resegmented) == len(case)
+    assert update.volume.volume_ul == pytest.approx(case_volume(case, **GEOMETRY).volume_ul, rel=1e-9)
+
+
+def test_unchanged_case_is_not_segmented_again(case, tmp_path):
+    first = update_case(case, tmp_path / "state", **GEOMETRY)
+    again = update_case(case, tmp_path / "state", **GEOMETRY)
+    assert not again.rebuilt
+    assert again.resegmented == [] and again.patched_rows == []
+    assert again.volume.volume_ul == pytest.approx(first.volume.volume_ul, rel=1e-12)
+
+
+@pytest.mark.parametrize("index", [0, 5, -1])
+def test_replaced_slice_is_patched_in(case, tmp_path, index):
+    update_case(case, tmp_path / "state", **GEOMETRY)
+    _replace_slice(case[index], case[2])
+
+    update = update_case(case, tmp_path / "state", **GEOMETRY)
+    assert not update.rebuilt
+    assert update.patched_rows == [index % len(case)]
+    # Same content as slice 2: served from the per-slice cache, not segmented again
+    assert update.resegmented == []
+    expected = case_volume(case, **GEOMETRY)
+    assert update.volume.volume_ul == pytest.approx(expected.volume_ul, rel=1e-9)
+    assert update.volume.areas_mm2 == pytest.approx(expected.areas_mm2, rel=1e-9)
+    assert np.array_equal(update.depth[index], update.depth[2])
+
+
+def test_new_slice_content_is_segmented_and_patched_in(case, tmp_path):
+    update_case(case, tmp_path / "state", **GEOMETRY)
+    with Image.open(case[6]) as img:
+        ImageOps.mirror(img).save(case[6])
+
+    update = update_case(case, tmp_path / "state", **GEOMETRY)
+    assert not update.rebuilt
+    assert update.patched_rows == [6] and update.resegmented == [case[6].name]
+    assert update.volume.volume_ul == pytest.approx(case_volume(case, **GEOMETRY).volume_ul, rel=1e-9)
+
+
+def test_removed_slices_rebuild(case, tmp_path):
+    update_case(case, tmp_path / "state", **GEOMETRY)
+    kept = case[:-2]   # new row count and scan spacing
+
+    update = update_case(kept, tmp_path / "state", **GEOMETRY)
+    assert update.rebuilt and update.patched_rows == []
+    assert update.resegmented == []
+    assert update.depth.shape[0] == len(kept)
+    assert update.volume.volume_ul == pytest.approx(case_volume(kept, **GEOMETRY).volume_ul, rel=1e-9)
+
+
+def test_renamed_slice_rebuilds(case, tmp_path):
+    update_case(case, tmp_path / "state", **GEOMETRY)
+    renamed = case[4].with_name("Final_pat_01004_rescan.tif")   # same count and geometry, new layout
+    case[4].rename(renamed)
+    case[4] = renamed
+
+    update = update_case(case, tmp_path / "state", **GEOMETRY)
+    assert update.rebuilt and update.patched_rows == []
+    assert update.resegmented == []
+    assert update.volume.volume_ul == pytest.approx(case_volume(case, **GEOMETRY).volume_ul, rel=1e-9)
+
+
+def test_update_from_packed_volume_matches_files(case, tmp_path):
+    volume = ensure_volume(case, tmp_path / "volume.npy")
+    from_pack = update_case(case, tmp_path / "packed", **GEOMETRY, volume=volume)
+    from_files = update_case(case, tmp_path / "files", **GEOMETRY)
+    assert from_pack.volume.volume_ul == from_files.volume.volume_ul
+    assert np.array_equal(from_pack.depth, from_files.depth)
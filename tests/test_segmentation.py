@@ -0,0 +1,92 @@
+# tests/test_segmentation.py
+# Anterior contour picking, checked on synthetic columns and against the
+# contours drawn (blue) on the bundled exported B-scans.
+
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from oct_pipeline.cli import uniform_slices
+from oct_pipeline.previews import list_source_slices
+from oct_pipeline.segmentation import (SegmentationParams, edge_step, pick_anterior_contour, read_stack,
+                                       segment_stack, sobel_y)
+
+IMG_DIR = Path(__file__).resolve().parent.parent / "images"
+
+
+def _drawn_contour(path: Path) -> np.ndarray:
+    """Top row of the blue contour line drawn on an exported slice, per column (NaN where absent)."""
+    rgb = np.asarray(Image.open(path).convert("RGB"), dtype=np.int16)
+    blue = (rgb[..., 2] > 180) & (rgb[..., 0] < 80)
+    rows = np.where(blue, np.arange(rgb.shape[0])[:, None], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # columns without any drawn pixel
+        return np.nanmin(rows, axis=0)
+
+
+def _column(height: int = 120, surface: int = 60) -> np.ndarray:
+    """(height, 32) uint8 slice: dark background above a bright cornea starting at `surface`."""
+    img = np.full((height, 32), 10, dtype=np.uint8)
+    img[surface:] = 200
+    return img
+
+
+# ===== SYNTHETIC =====
+def test_edge_step_sums_the_gradient_below():
+    grad = np.zeros((10, 1), dtype=np.float32)
+    grad[3] = 1.0
+    grad[4] = -1.0
+    step = edge_step(grad, run=3)
+    assert step[3, 0] == pytest.approx(0.0)     # up then down again: no lasting step
+    assert step[1, 0] == pytest.approx(1.0)     # rows 1..3 only see the rise
+    assert step[9, 0] == pytest.approx(0.0)     # the run is cut at the bottom of the column
+
+
+@pytest.mark.parametrize("speckle", ["pixel", "line"])
+def test_bright_speckle_above_the_cornea_is_skipped(speckle):
+    img = _column()
+    if speckle == "pixel":
+        img[25, 10:12] = 255
+    else:
+        img[40, :] = 255                          # a drawn 1 px line across the slice
+    result = segment_stack(img)
+    # Sobel puts the step between the dark and bright rows
+    assert np.nanmax(np.abs(result.contours[0, 8:-8] - 59)) <= 1
+
+
+def test_first_hit_rule_without_step_takes_the_top_edge():
+    img = _column()
+    img[25, :] = 255
+    grad = sobel_y(img[None])
+    assert np.nanmin(pick_anterior_contour(np.where(grad > 0.1, grad, 0.0))[0, 8:-8]) < 30
+
+
+def test_frame_edge_is_not_the_contour():
+    img = _column()
+    img[:4] = 255                                 # white export frame
+    img[-5:] = 255
+    contours = segment_stack(img).contours[0]
+    assert np.all(np.abs(contours[8:-8] - 59) <= 1)
+
+
+# ===== BUNDLED CASES =====
+@pytest.mark.parametrize("case", ["oct_segmentation1", "oct_segmentation2", "oct_segmentation3"])
+def test_contour_matches_drawn_contour(case):
+    paths, _ = uniform_slices(list_source_slices(IMG_DIR / case))
+    result = segment_stack(read_stack(paths))
+    drawn = np.stack([_drawn_contour(p) for p in paths])
+    err = np.abs(result.contours - drawn)
+    per_slice = np.nanmedian(err, axis=1)
+    assert per_slice.max() <= 4, f"median px error per slice: {per_slice.tolist()}"
+    assert np.nanpercentile(err, 90) <= 8
+
+
+def test_no_lesion_reported_on_a_healthy_column():
+    # Healthy surface at this column (the first-hit rule reported an 11 px deep lesion)
+    path = IMG_DIR / "oct_segmentation3" / "Final_pat_01010.tif"
+    result = segment_stack(read_stack([path]), SegmentationParams())
+    assert abs(result.contours[0, 350] - _drawn_contour(path)[350]) <= 2
+    assert result.depth[0, 350] < 5